@@ -0,0 +1,183 @@
+import json
+import queue
+import threading
+from datetime import datetime
+from urllib.request import Request, urlopen
+from lazy import LazyModule
+from features import POLLUTANTS
+
+np = LazyModule("numpy")
+pd = LazyModule("pandas")
+
+# Maximum single concentration limits (ПДК м.р.), mg/m3
+LIMITS = {"co": 5.0, "no2": 0.2, "no": 0.4, "pm10": 0.3, "pm25": 0.16}
+
+# A rule fires when the forecast of its pollutant exceeds threshold at any horizon
+DEFAULT_RULES = [{"pollutant": pollutant, "threshold": limit, "level": "ПДК"}
+                 for pollutant, limit in LIMITS.items()] +\
+                [{"pollutant": pollutant, "threshold": 5 * limit, "level": "5 ПДК"}
+                 for pollutant, limit in LIMITS.items()]
+
+
+class QueueSink():
+
+    # Alerts for consumers in this process
+
+    def __init__(self, maxsize=1000):
+        self.queue = queue.Queue(maxsize)
+
+
+    def send(self, alert):
+        try:
+            self.queue.put_nowait(alert)
+        except queue.Full:
+            # Drop the oldest alert rather than block the forecast path
+            self.queue.get_nowait()
+            self.queue.put_nowait(alert)
+
+
+class FileSink():
+
+    # One JSON object per line
+
+    def __init__(self, path="alerts.jsonl"):
+        self.path = path
+        self.lock = threading.Lock()
+
+
+    def send(self, alert):
+        with self.lock:
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(json.dumps(alert, ensure_ascii=False) + "\n")
+
+
+class WebhookSink():
+
+    # POSTs alerts as JSON. Without a URL the alerts are only printed.
+
+    def __init__(self, url=None, timeout=5):
+        self.url = url
+        self.timeout = timeout
+
+
+    def send(self, alert):
+        if self.url is None:
+            print(f"Alert: {alert}")
+            return
+        body = json.dumps(alert, ensure_ascii=False).encode("utf-8")
+        request = Request(self.url, data=body, headers={"Content-Type": "application/json"})
+        try:
+            urlopen(request, timeout=self.timeout).close()
+        except BaseException:
+            print(f"Failed to send alert to {self.url}")
+
+
+class AlertEngine():
+
+    # Evaluates the rules on every "now" forecast as it is stored (see
+    # Predictor.forecast_listeners). All rules are checked against all horizons
+    # in one comparison of the (horizons, rules) matrix. Per-station maxima over
+    # the horizons are kept, so a forecast below the lowest threshold and
+    # city-wide queries only look at the summaries.
+    # An alert for (station, pollutant, level) is sent once while the exceedance
+    # lasts, and again after repeat_interval seconds.
+
+    def __init__(self, rules=DEFAULT_RULES, sinks=None, repeat_interval=3 * 3600):
+        self.rules = rules
+        self.sinks = sinks if sinks is not None else [QueueSink()]
+        self.repeat_interval = repeat_interval
+        self.pollutant_index = {pollutant: i for i, pollutant in enumerate(POLLUTANTS)}
+        self.rule_columns = np.array([self.pollutant_index[rule["pollutant"]] for rule in rules])
+        self.thresholds = np.array([rule["threshold"] for rule in rules], dtype=np.float64)
+        self.summaries = {}
+        self.active = {}
+        self.lock = threading.Lock()
+
+
+    def forecast_matrix(self, forecast):
+        # Forecast Timestamps and (horizons, pollutants) values, NaN for pollutants
+        # without a model. "now" results are time zone aware, and mixing zones
+        # of the sources leaves the datetime column with object dtype.
+        rows = forecast.loc[forecast["value_type"] == "Прогноз"]
+        values = np.full((rows.shape[0], len(POLLUTANTS)), np.nan)
+        for pollutant, i in self.pollutant_index.items():
+            if pollutant in rows.columns:
+                values[:, i] = rows[pollutant].to_numpy(dtype=np.float64)
+        return [pd.Timestamp(value) for value in rows["datetime"]], values
+
+
+    def consume(self, station_number, date, forecast):
+        if date != "now":
+            return []
+        datetimes, values = self.forecast_matrix(forecast)
+        if values.shape[0] == 0:
+            return []
+        # Missing values never exceed a threshold
+        values = np.where(np.isnan(values), -np.inf, values)
+        summary = values.max(axis=0)
+        with self.lock:
+            self.summaries[station_number] = summary
+
+        firing = summary[self.rule_columns] > self.thresholds
+        if not firing.any():
+            self.resolve(station_number, set())
+            return []
+
+        # Horizon details only for the rules that fire
+        rule_ids = np.flatnonzero(firing)
+        rule_values = values[:, self.rule_columns[rule_ids]]
+        first_hours = (rule_values > self.thresholds[rule_ids]).argmax(axis=0)
+        peak_hours = rule_values.argmax(axis=0)
+
+        alerts = []
+        for rule_id, first_hour, peak_hour in zip(rule_ids, first_hours, peak_hours):
+            rule = self.rules[rule_id]
+            column = self.rule_columns[rule_id]
+            alerts.append({"station": station_number,
+                           "pollutant": rule["pollutant"],
+                           "level": rule["level"],
+                           "threshold": rule["threshold"],
+                           "peak": float(values[peak_hour, column]),
+                           "peak_time": datetimes[peak_hour].isoformat(timespec="minutes"),
+                           "first_exceedance_time": datetimes[first_hour].isoformat(timespec="minutes"),
+                           "horizon": int(first_hour) + 1,
+                           "issued": datetime.now().isoformat(timespec="seconds")})
+
+        sent = self.deduplicate(station_number, alerts)
+        for alert in sent:
+            for sink in self.sinks:
+                sink.send(alert)
+        return sent
+
+
+    def deduplicate(self, station_number, alerts):
+        now = datetime.now()
+        sent = []
+        with self.lock:
+            for alert in alerts:
+                key = (station_number, alert["pollutant"], alert["level"])
+                last_sent = self.active.get(key)
+                if last_sent is None or (now - last_sent).total_seconds() > self.repeat_interval:
+                    self.active[key] = now
+                    sent.append(alert)
+        self.resolve(station_number, {(station_number, alert["pollutant"], alert["level"]) for alert in alerts})
+        return sent
+
+
+    def resolve(self, station_number, firing_keys):
+        # Forget exceedances that ended, so a new one is alerted again
+        with self.lock:
+            for key in [key for key in self.active if key[0] == station_number and key not in firing_keys]:
+                del self.active[key]
+
+
+    def exceeding_stations(self):
+        # {station: [rules]} for all stations from the max-over-horizon summaries
+        with self.lock:
+            stations = list(self.summaries)
+            if not stations:
+                return {}
+            summaries = np.stack([self.summaries[station] for station in stations])
+        firing = summaries[:, self.rule_columns] > self.thresholds
+        return {stations[i]: [self.rules[j] for j in np.flatnonzero(firing[i])]
+                for i in np.flatnonzero(firing.any(axis=1))}
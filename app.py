@@ -1,34 +1,149 @@
+import time
+import argparse
+
+startup_time = time.perf_counter()
+
+import flask
 import dash
 from dash import dcc
 from dash import html
 import dash_leaflet as dl
 import dash_leaflet.express as dlx
-import csv
 from dash.dependencies import Output, Input
-import pandas as pd
-import plotly.express as px
 from predictor import Predictor
+from pipeline_pool import PipelinePool
+from figures import FigureCache, build_figure, zoom_range
+from alerts import AlertEngine, FileSink, WebhookSink
+from scheduler import CoordinationStore
+from monitoring import ForecastMonitor
+import profiling
+from profiling import profiled
 import dash_bootstrap_components as dbc
 
+parser = argparse.ArgumentParser()
+parser.add_argument("--fast-start", action="store_true",
+                    help="Load heavy dependencies and cached data lazily, preload in the background")
+parser.add_argument("--incremental", action="store_true",
+                    help="Refresh current data from per-station hourly buffers instead of rebuilding it")
+parser.add_argument("--refresh-interval", type=int, default=0,
+                    help="Refresh current data for all stations every N seconds to keep the buffers filled")
+parser.add_argument("--inference-backend", choices=["catboost", "compiled"], default="catboost",
+                    help="Run models with CatBoost or with the compiled NumPy evaluator")
+parser.add_argument("--uncertainty-members", type=int, default=0,
+                    help="Virtual ensemble size for prediction intervals, 0 for point forecasts only")
+parser.add_argument("--workers", type=int, default=2,
+                    help="Worker processes for the pipeline, 0 to run it in the request thread")
+parser.add_argument("--alerts-file", default=None,
+                    help="Evaluate exceedance alerts on every forecast and append them to this file")
+parser.add_argument("--alert-webhook", default=None,
+                    help="Also POST exceedance alerts to this URL")
+parser.add_argument("--no-archive", action="store_true",
+                    help="Do not append the downloaded observations to the dataset")
+parser.add_argument("--monitoring-store", default="monitoring.sqlite",
+                    help="Compare issued forecasts with observations here, statistics are served on /metrics")
+parser.add_argument("--profile-startup", action="store_true",
+                    help="Report startup timings and time to the first response")
+parser.add_argument("--profiling", action="store_true",
+                    help="Serve /profiling/start and /profiling/stop to sample all threads at runtime")
+parser.add_argument("--profile-slow-ms", type=float, default=None,
+                    help="Write the sampled stacks of data loading and callback calls slower than this")
+parser.add_argument("--profile-allocations", action="store_true",
+                    help="Record memory allocated by merges, appends and feature generation (slow)")
+parser.add_argument("--profiles-dir", default=profiling.PROFILES_PATH)
+args, _ = parser.parse_known_args()
+
+profiling_options = {"path": args.profiles_dir,
+                     "slow_threshold": args.profile_slow_ms / 1000 if args.profile_slow_ms is not None else None,
+                     "allocations": args.profile_allocations}
+profiling.configure(**profiling_options)
+
 app = dash.Dash(__name__, 
                 external_stylesheets=[dbc.themes.BOOTSTRAP])
 
-P = Predictor()
+imports_done_time = time.perf_counter()
+
+P = Predictor(fast_start=args.fast_start, incremental=args.incremental,
+              refresh_interval=args.refresh_interval, inference_backend=args.inference_backend,
+              uncertainty_members=args.uncertainty_members, archive=not args.no_archive)
+
+predictor_ready_time = time.perf_counter()
+
+figure_cache = FigureCache()
+
+# Stations open in the UI are refreshed first by the refresh scheduler. Every
+# open tab polls while data loads, so a station is marked at most once a minute.
+refresh_store = CoordinationStore()
+viewed_marks = {}
+
+
+def mark_viewed(station_id, interval=60):
+    now = time.time()
+    if now - viewed_marks.get(station_id, 0) >= interval:
+        viewed_marks[station_id] = now
+        refresh_store.mark_viewed(station_id)
+
+if args.alerts_file or args.alert_webhook:
+    sinks = []
+    if args.alerts_file:
+        sinks.append(FileSink(args.alerts_file))
+    if args.alert_webhook:
+        sinks.append(WebhookSink(args.alert_webhook))
+    alert_engine = AlertEngine(sinks=sinks)
+    P.forecast_listeners.append(alert_engine.consume)
+
+# Forecast error statistics per station, pollutant and horizon
+monitor = ForecastMonitor(args.monitoring_store)
+P.forecast_listeners.append(monitor.consume)
 
-with open("stations.csv", "r") as f:
-    reader = csv.reader(f)
-    stations = {}
-    station_markers = []
-    for row in reader:
-        station_id = int(row[0])
-        station_name = row[1]
-        lat = float(row[2])
-        lon = float(row[3])
-        station_marker = dl.CircleMarker(center=(lat, lon), id=f"station_{station_id}", color="#0000A8")
-        station_markers.append(station_marker)
-        stations[station_id] = (lat, lon, station_name)
 
-plot = px.line()
+@app.server.route("/metrics")
+def metrics():
+    return flask.Response(monitor.metrics_text(), mimetype="text/plain; version=0.0.4")
+
+
+pool = PipelinePool(P, workers=args.workers,
+                    predictor_options={"incremental": args.incremental,
+                                       "inference_backend": args.inference_backend,
+                                       "uncertainty_members": args.uncertainty_members,
+                                       "archive": not args.no_archive},
+                    on_result=figure_cache.fill,
+                    profiling_options=profiling_options,
+                    shared_store=refresh_store)
+
+if args.profiling:
+    
+    @app.server.route("/profiling/start", methods=["POST"])
+    def start_profiling():
+        started = profiling.start_sampling()
+        return {"sampling": True, "started": started}
+    
+    @app.server.route("/profiling/stop", methods=["POST"])
+    def stop_profiling():
+        return {"sampling": False, "profile": profiling.stop_sampling()}
+    
+    @app.server.route("/profiling/allocations")
+    def allocations():
+        return profiling.allocation_summary()
+
+if args.profile_startup:
+    print(f"Startup: imports took {imports_done_time - startup_time:.3f} s, "
+          f"predictor took {predictor_ready_time - imports_done_time:.3f} s")
+    first_response = {"reported": False}
+    
+    @app.server.after_request
+    def report_first_response(response):
+        if not first_response["reported"]:
+            first_response["reported"] = True
+            print(f"Startup: first response after {time.perf_counter() - startup_time:.3f} s")
+        return response
+
+stations = P.registry
+station_markers = [dl.CircleMarker(center=(stations.coords(station_id)["lat"], stations.coords(station_id)["lon"]),
+                                   id=f"station_{station_id}", color="#0000A8")
+                   for station_id in stations.ids()]
+
+# Empty figure until the first callback fills the plot
+plot = {}
 
 app.layout = html.Div(children=[
     html.Div(children=[
@@ -42,19 +157,8 @@ app.layout = html.Div(children=[
     html.Div(children=[
     html.Div(children=[html.Label("Станция мониторинга", className="mt-4"),
                        dcc.Dropdown(id="station",
-                                    options=[
-                                        {"label": "Туристская", "value": 1},
-                                        {"label": "Коптевский бульвар", "value": 2},
-                                        {"label": "Останкино 0", "value": 3},
-                                        {"label": "Глебовская", "value": 4},
-                                        {"label": "Спиридоновка", "value": 5},
-                                        {"label": "Шаболовка", "value": 6},
-                                        {"label": "Академика Анохина", "value": 7},
-                                        {"label": "Бутлерова", "value": 8},
-                                        {"label": "Пролетарский проспект", "value": 9},
-                                        {"label": "Марьино", "value": 10}
-                                        ],
-                                    value=1,
+                                    options=stations.options(),
+                                    value=stations.ids()[0],
                                     className="mb-3",
                                     clearable=False),
                             html.Label("Дата"),
@@ -82,6 +186,8 @@ app.layout = html.Div(children=[
            zoom=10,
            style={'width': '100%', 'height': '100%'},
            id="map"),
+    # Polls for results while the pipeline is running in the worker pool
+    dcc.Interval(id="pipeline_poll", interval=1000, disabled=True),
     dcc.Graph(id="station_plot",
               figure=plot,
               style={"position": "absolute", "bottom": 0, "z-index": "1000", "width": "100%", "height": "40%", "padding": "5px"})
@@ -95,6 +201,7 @@ app.layout = html.Div(children=[
     Input(component_id="map", component_property="click_lat_lng"),
     prevent_initial_call=True
     )
+@profiled("add_marker")
 def add_marker(click_lat_lng):
     return [dl.Circle(center=click_lat_lng, radius=16, color="#EC0E43", fill=True, fillOpacity=1, stroke=False),
             dl.Circle(center=click_lat_lng, radius=160, color="#78797A", fill=True, fillOpacity=0.3, stroke=False)]
@@ -104,41 +211,41 @@ def add_marker(click_lat_lng):
     Input(component_id="map", component_property="click_lat_lng"),
     prevent_initial_call=True
     )
+@profiled("select_nearset_station")
 def select_nearset_station(latlng):
     click_lat = latlng[0]
     click_lon = latlng[1]
-    with open("stations.csv", "r") as f:
-        reader = csv.reader(f)
-        nearest_station = 0
-        nearest_station_coords = (0, 0)
-        min_distance = 1000
-        for row in reader:
-            station_id = int(row[0])
-            lat = float(row[2])
-            lon = float(row[3])
-            distance = ((lat - click_lat)**2 + (lon-click_lon)**2)**0.5
-            if distance < min_distance:
-                min_distance = distance
-                nearest_station = station_id
-                nearest_station_coords = (lat, lon)
-    highlighted_marker = dl.CircleMarker(center=nearest_station_coords, color="#EC0E43", fill=False)
-    zoom = 13
+    nearest_station = stations.nearest(click_lat, click_lon)
     return nearest_station
 
 @app.callback(
     Output(component_id="station_plot", component_property="figure"),
     Output(component_id="station_info", component_property="children"),
+    Output(component_id="pipeline_poll", component_property="disabled"),
     Input(component_id="station", component_property="value"),
     Input(component_id="date", component_property="value"),
-    Input(component_id="pollutant", component_property="value")
+    Input(component_id="pollutant", component_property="value"),
+    Input(component_id="pipeline_poll", component_property="n_intervals"),
+    Input(component_id="station_plot", component_property="relayoutData")
     )
-def update_plot_and_info(station_id, date, pollutant):
-    df = P.get_data(station_id, date)
-    station = stations[int(station_id)]
-    station_name = station[2]
-    station_coords = f"{station[0]} N, {station[1]} E"
+@profiled("update_plot_and_info")
+def update_plot_and_info(station_id, date, pollutant, n_intervals, relayout_data):
+    station_id = int(station_id)
+    station_name = stations.name(station_id)
+    station_coords = f"{stations.coords(station_id)['lat']} N, {stations.coords(station_id)['lon']} E"
+    if date == "now":
+        mark_viewed(station_id)
+    df = pool.get_data(station_id, date)
+    if df is None:
+        if pool.is_failed(station_id, date):
+            message, keep_polling = "Не удалось загрузить данные", False
+        else:
+            message, keep_polling = "Данные загружаются…", True
+        info = [html.H3(children=station_name, className="mt-5"),
+                html.P(children=station_coords, className="fst-italic"),
+                html.P(children=message)]
+        return {}, info, not keep_polling
     current_row = df.loc[(df.value_type == "Факт") | (df.value_type == "fact")].iloc[-2]
-    print(current_row)
     current_values = ["Концентрация загрязнителей на ", html.Nobr(current_row.iat[0].strftime("%H:%M %d.%m.%Y")),
         " (мг/м3):", html.Br()]
     values_list = []
@@ -148,22 +255,32 @@ def update_plot_and_info(station_id, date, pollutant):
         if value is not None:
             values_list.append(html.Li(f"{pollutant_name} — {value}"))
     current_values.append(html.Ul(children=values_list))
-    plot = px.line(df, x="datetime", y=pollutant, color="value_type",
-                   labels={"datetime": "Дата и время", pollutant: f"{pollutant.upper()}, мг/м3",
-                           "value_type": "Значение"},
-                   color_discrete_map={"fact": "#EC0E43", "forecast": "#0000A8",
-                                       "Факт": "#EC0E43", "Прогноз": "#0000A8",
-                                       "OpenWeatherMap": "#B470AD"})
+    # Zooming re-fetches the visible range at full resolution, the zoomed out
+    # figure is downsampled and cached
+    triggered = [t["prop_id"] for t in dash.callback_context.triggered]
+    x_range = zoom_range(relayout_data) if "station_plot.relayoutData" in triggered else None
+    if x_range is not None:
+        plot = build_figure(df, pollutant, x_range=x_range)
+    else:
+        version = P.cache.version(P.forecast_key(station_id, date))
+        plot = figure_cache.get_figure(station_id, date, pollutant, df, version)
     info = [html.H3(children=station_name, className="mt-5"),
             html.P(children=station_coords, className="fst-italic"),
             html.P(children=current_values)]
-    return plot, info
+    if df.attrs.get("mode") == "degraded":
+        substitutes = {"buffer": "последних полученных измерениях станции",
+                       "owm": "данных OpenWeatherMap"}
+        source = substitutes.get(df.attrs["sources"]["pollution"], "устаревших данных метеопрофилемера")
+        info.append(html.P(children=f"Данные станции недоступны, прогноз построен на {source}",
+                           className="text-warning"))
+    return plot, info, True
 
 @app.callback(
     Output(component_id="date", component_property="options"),
     Output(component_id="date", component_property="value"),
     Input(component_id="station", component_property="value")
     )
+@profiled("get_dates_for_station")
 def get_dates_for_station(station_id):
     options = P.get_date_options(station_id)
     default_value = options[0]["value"]
@@ -175,9 +292,10 @@ def get_dates_for_station(station_id):
     Input(component_id="station", component_property="value"),
     Input(component_id="date", component_property="value"),
     )
+@profiled("get_pollutants_for_station")
 def get_pollutants_for_station(station_id, date):
     options = P.get_pollutant_options(station_id, date)
-    default_value = options[0]["value"]
+    default_value = options[0]["value"] if options else ""
     return options, default_value
 
 @app.callback(
@@ -188,10 +306,11 @@ def get_pollutants_for_station(station_id, date):
     Input(component_id="map", component_property="click_lat_lng"),
     prevent_initial_call=True
     )
+@profiled("zoom_move_hightlight")
 def zoom_move_hightlight(station_id, latlng):
-    station = stations[int(station_id)]
-    click_lat = station[0]
-    click_lon = station[1]
+    coords = stations.coords(int(station_id))
+    click_lat = coords["lat"]
+    click_lon = coords["lon"]
     nearest_station_coords = (click_lat, click_lon)
     highlighted_marker = dl.CircleMarker(center=nearest_station_coords, color="#EC0E43")
     zoom = 13
@@ -0,0 +1,95 @@
+# Compares the CatBoost inference path with the compiled NumPy evaluator:
+# per-row latency, batch throughput and the largest difference of predictions.
+#
+# python benchmark_inference.py                     # models in pretrained_models/
+# python benchmark_inference.py --dummy             # a synthetic model shaped like ours
+
+import sys
+import glob
+import time
+import argparse
+import numpy as np
+import pandas as pd
+from catboost import CatBoostRegressor
+from compiled_model import ObliviousTreeModel
+
+
+def train_dummy_model(n_features=330, n_targets=24):
+    rng = np.random.default_rng(33)
+    X = rng.random((2000, n_features))
+    y = X[:, :n_targets] * 2 + rng.random((2000, n_targets))
+    catboost_params = {
+        "iterations": 100,
+        "verbose": 0,
+        "learning_rate": 1,
+        "depth": 8,
+        "loss_function": "MultiRMSE",
+        "allow_writing_files": False}
+    return CatBoostRegressor(**catboost_params).fit(X, y)
+
+
+def timeit(function, repeats):
+    start = time.perf_counter()
+    for _ in range(repeats):
+        function()
+    return (time.perf_counter() - start) / repeats
+
+
+def benchmark(name, model, rows, batch_rows, tolerance):
+    compiled_model = ObliviousTreeModel.from_catboost(model)
+    columns = model.feature_names_
+    row_frame = pd.DataFrame(rows[:1], columns=columns)
+    batch_frame = pd.DataFrame(batch_rows, columns=columns)
+    batch_array = np.ascontiguousarray(batch_rows, dtype=np.float32)
+    
+    paths = {
+        "catboost (DataFrame)": (lambda: model.predict(row_frame), lambda: model.predict(batch_frame)),
+        "catboost (float32 array)": (lambda: model.predict(batch_array[:1]), lambda: model.predict(batch_array)),
+        "compiled": (lambda: compiled_model.predict(batch_array[:1]), lambda: compiled_model.predict(batch_array))
+    }
+    
+    print(f"Model {name}: {compiled_model.tree_count} trees, {len(columns)} features")
+    for path_name, (predict_row, predict_batch) in paths.items():
+        row_latency = timeit(predict_row, 200)
+        batch_time = timeit(predict_batch, 3)
+        print(f"  {path_name:<26} {row_latency * 1000:8.3f} ms per row, "
+              f"{batch_rows.shape[0] / batch_time:12.0f} rows/s in batches of {batch_rows.shape[0]}")
+    
+    difference = np.abs(np.asarray(model.predict(batch_frame)) - compiled_model.predict(batch_array)).max()
+    print(f"  max abs difference: {difference:.3e}")
+    return difference <= tolerance
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--models", default="pretrained_models/*.cbm")
+    parser.add_argument("--dummy", action="store_true", help="Benchmark a synthetic depth 8 MultiRMSE model")
+    parser.add_argument("--batch-size", type=int, default=10000)
+    parser.add_argument("--tolerance", type=float, default=1e-5)
+    args = parser.parse_args()
+    
+    models = {}
+    if args.dummy:
+        models["dummy"] = train_dummy_model()
+    for path in sorted(glob.glob(args.models)):
+        model = CatBoostRegressor()
+        model.load_model(path)
+        models[path] = model
+    if not models:
+        print("No models found. Use --dummy to benchmark a synthetic model.")
+        return 1
+    
+    rng = np.random.default_rng(0)
+    passed = True
+    for name, model in models.items():
+        n_features = len(model.feature_names_)
+        batch_rows = rng.normal(size=(args.batch_size, n_features))
+        batch_rows[rng.random(batch_rows.shape) < 0.05] = np.nan
+        passed &= benchmark(name, model, batch_rows[:1], batch_rows, args.tolerance)
+    
+    print("Parity check passed" if passed else "Parity check FAILED")
+    return 0 if passed else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
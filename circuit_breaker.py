@@ -0,0 +1,90 @@
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+class CircuitBreaker():
+
+    # Guards an upstream source. After failure_threshold consecutive failures
+    # (errors or calls over latency_budget seconds) the circuit opens and calls
+    # fail immediately for reset_timeout seconds. Then one trial call is let
+    # through: success closes the circuit, failure opens it again.
+    # Calls run in the breaker's own threads, so a caller waits at most the
+    # latency budget. A call that is over the budget is abandoned, not
+    # interrupted, and keeps its thread until it returns, so callers should set
+    # their own timeouts too. Hung calls of one source never hold up another.
+
+    def __init__(self, name, latency_budget=10, failure_threshold=3, reset_timeout=300, max_workers=4):
+        self.name = name
+        self.latency_budget = latency_budget
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.trial_running = False
+        self.lock = threading.Lock()
+        self.max_workers = max_workers
+        self.executor = None
+
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at < self.reset_timeout:
+            return "open"
+        return "half-open"
+
+
+    def get_executor(self):
+        with self.lock:
+            if self.executor is None:
+                self.executor = ThreadPoolExecutor(max_workers=self.max_workers,
+                                                   thread_name_prefix=f"upstream-{self.name}")
+        return self.executor
+
+
+    def allow(self):
+        with self.lock:
+            state = self.state
+            if state == "closed":
+                return True
+            if state == "half-open" and not self.trial_running:
+                self.trial_running = True
+                return True
+            return False
+
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+            self.trial_running = False
+
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.trial_running or self.failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+            self.trial_running = False
+
+
+    def call(self, func, *args, **kwargs):
+        if not self.allow():
+            raise CircuitOpenError(f"{self.name} is unavailable")
+        future = self.get_executor().submit(func, *args, **kwargs)
+        try:
+            result = future.result(timeout=self.latency_budget)
+        except FutureTimeoutError:
+            self.record_failure()
+            raise TimeoutError(f"{self.name} did not respond in {self.latency_budget} s")
+        except BaseException:
+            self.record_failure()
+            raise
+        self.record_success()
+        return result
@@ -0,0 +1,165 @@
+import os
+import json
+import tempfile
+from lazy import LazyModule
+
+np = LazyModule("numpy")
+
+
+def ensemble_step(tree_count, members):
+    # Virtual ensemble members are the model truncated after every step trees,
+    # the last `members` truncations (the full model included) cover its second half
+    return max(tree_count // (2 * members), 1)
+
+
+def ensemble_ends(tree_count, members):
+    # Tree counts of the members, the same truncations CatBoost staged_predict
+    # yields with eval_period=ensemble_step(...)
+    step = ensemble_step(tree_count, members)
+    ends = [min(stage * step, tree_count) for stage in range(1, -(-tree_count // step) + 1)]
+    return np.array(ends[-members:])
+
+
+class ObliviousTreeModel():
+    
+    # NumPy evaluator for CatBoost models with numeric features only (as all models here are).
+    # The trees are kept as dense arrays, so a batch of rows is evaluated by all trees
+    # in a few vectorized operations without DataFrame → Pool conversion.
+    
+    def __init__(self, features, borders, leaf_values, scale, bias, nan_as_true, feature_names=None):
+        self.features = features            # (trees, depth) feature index of every split
+        self.borders = borders              # (trees, depth) float32 split borders
+        self.leaf_values = leaf_values      # (trees, 2 ** depth, dimension)
+        self.scale = scale
+        self.bias = bias
+        self.nan_as_true = nan_as_true      # features where NaN goes to the "greater" side
+        self.feature_names = feature_names  # column order the model expects, if known
+        self.powers = (1 << np.arange(features.shape[1])).astype("int64")
+    
+    
+    @property
+    def tree_count(self):
+        return self.features.shape[0]
+    
+    
+    @classmethod
+    def from_catboost(cls, model):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, "model.json")
+            model.save_model(path, format="json")
+            with open(path, "r") as f:
+                return cls.from_json(json.load(f))
+    
+    
+    @classmethod
+    def from_json(cls, model_json):
+        float_features = model_json["features_info"]["float_features"]
+        feature_count = max(f["flat_feature_index"] for f in float_features) + 1
+        nan_as_true = np.zeros(feature_count, dtype=bool)
+        feature_names = [""] * feature_count
+        for feature in float_features:
+            if feature.get("nan_value_treatment") == "AsTrue":
+                nan_as_true[feature["flat_feature_index"]] = True
+            feature_names[feature["flat_feature_index"]] = feature.get("feature_id", "")
+        if not all(feature_names):
+            feature_names = None
+        
+        trees = model_json["oblivious_trees"]
+        depth = max(len(tree["splits"]) for tree in trees)
+        dimension = len(trees[0]["leaf_values"]) // (1 << len(trees[0]["splits"]))
+        
+        # Shallower trees are padded with splits that are never true,
+        # so their extra leaves are never reached
+        features = np.zeros((len(trees), depth), dtype="int64")
+        borders = np.full((len(trees), depth), np.inf, dtype="float32")
+        leaf_values = np.zeros((len(trees), 1 << depth, dimension), dtype="float64")
+        for i, tree in enumerate(trees):
+            for j, split in enumerate(tree["splits"]):
+                features[i, j] = float_features[split["float_feature_index"]]["flat_feature_index"]
+                borders[i, j] = split["border"]
+            values = np.asarray(tree["leaf_values"], dtype="float64").reshape(-1, dimension)
+            leaf_values[i, :values.shape[0]] = values
+        
+        scale, bias = model_json.get("scale_and_bias", [1, [0]])
+        bias = np.atleast_1d(np.asarray(bias, dtype="float64"))
+        return cls(features, borders, leaf_values, float(scale), bias, nan_as_true, feature_names)
+    
+    
+    def save(self, path):
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            np.savez(f, features=self.features, borders=self.borders, leaf_values=self.leaf_values,
+                     scale=np.array(self.scale), bias=self.bias, nan_as_true=self.nan_as_true,
+                     feature_names=np.array(self.feature_names or []))
+        os.replace(tmp_path, path)
+    
+    
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as saved:
+            feature_names = [str(name) for name in saved["feature_names"]] or None
+            return cls(saved["features"], saved["borders"], saved["leaf_values"],
+                       float(saved["scale"]), saved["bias"], saved["nan_as_true"], feature_names)
+    
+    
+    def frame_to_array(self, frame):
+        # Like CatBoost, match DataFrame columns to the model features by name
+        if self.feature_names is not None:
+            frame = frame.loc[:, self.feature_names]
+        return np.ascontiguousarray(frame.to_numpy(dtype="float32"))
+    
+    
+    def prepare(self, data):
+        data = np.ascontiguousarray(data, dtype="float32")
+        if data.ndim == 1:
+            data = data[None, :]
+        if self.nan_as_true.any():
+            data = data.copy()
+            columns = data[:, self.nan_as_true]
+            data[:, self.nan_as_true] = np.where(np.isnan(columns), np.inf, columns)
+        return data
+    
+    
+    def leaf_indices(self, data):
+        # (rows, trees) index of the leaf every row falls into in every tree
+        bits = data[:, self.features] > self.borders
+        return bits.astype("int64") @ self.powers
+    
+    
+    def tree_outputs(self, data):
+        # (rows, trees, dimension) raw output of every tree, before scale and bias
+        data = self.prepare(data)
+        return self.leaf_values[np.arange(self.tree_count)[None, :], self.leaf_indices(data)]
+    
+    
+    def predict(self, data, batch_size=256):
+        # Small batches keep the (rows, trees, dimension) intermediate array in cache
+        data = self.prepare(data)
+        results = []
+        for start in range(0, data.shape[0], batch_size):
+            batch = data[start:start + batch_size]
+            leaf_indices = self.leaf_indices(batch)
+            outputs = self.leaf_values[np.arange(self.tree_count)[None, :], leaf_indices]
+            results.append(outputs.sum(axis=1) * self.scale + self.bias)
+        result = np.concatenate(results) if results else np.zeros((0, self.bias.shape[0]))
+        if result.shape[1] == 1:
+            return result[:, 0]
+        return result
+    
+    
+    def predict_ensemble(self, data, members=10, batch_size=256):
+        # (rows, members, dimension) predictions of the virtual ensemble members
+        # from one evaluation of the trees: the member outputs are prefix sums
+        # of the tree outputs
+        data = self.prepare(data)
+        ends = ensemble_ends(self.tree_count, members)
+        results = []
+        for start in range(0, data.shape[0], batch_size):
+            batch = data[start:start + batch_size]
+            leaf_indices = self.leaf_indices(batch)
+            outputs = self.leaf_values[np.arange(self.tree_count)[None, :], leaf_indices]
+            prefix_sums = np.cumsum(outputs, axis=1)[:, ends - 1]
+            results.append(prefix_sums * self.scale + self.bias)
+        if not results:
+            return np.zeros((0, len(ends), self.bias.shape[0]))
+        return np.concatenate(results)
@@ -0,0 +1,204 @@
+import os
+import time
+import fcntl
+import threading
+from multiprocessing.util import Finalize
+from contextlib import contextmanager
+from os.path import isfile, isdir
+from lazy import LazyModule
+from validation import apply_masks, validate
+
+pd = LazyModule("pandas")
+
+# Hourly observations stored as Parquet files partitioned by source and month:
+#   dataset/<station id>/<YYYY-MM>.parquet   pollutants and weather of a station
+#   dataset/ostankino/<YYYY-MM>.parquet      Ostankino meteoprofile and 253 m wind
+# Times are naive Moscow local time. Files are written by ingest.py from the raw
+# archives and by DatasetAppender from the data Predictor downloads.
+# Parquet support needs pyarrow.
+
+DATASET_PATH = "dataset/"
+
+STATION_COLUMNS = {
+    "Дата и время": "datetime",
+    "CO": "co",
+    "NO2": "no2",
+    "NO": "no",
+    "PM10": "pm10",
+    "PM2.5": "pm25",
+    "-T-": "temperature",
+    "| V |": "wind_speed",
+    "_V_": "wind_direction",
+    "Давление": "pressure",
+    "Влажность": "humidity",
+    "Осадки": "precipitation"
+}
+
+PROFILE_COLUMNS = {
+    "data time": "datetime",
+    "0": "t_0m",
+    "50": "t_50m",
+    "100": "t_100m",
+    "150": "t_150m",
+    "200": "t_200m",
+    "250": "t_250m",
+    "300": "t_300m",
+    "350": "t_350m",
+    "400": "t_400m",
+    "450": "t_450m",
+    "500": "t_500m",
+    "550": "t_550m",
+    "600": "t_600m",
+    "OutsideTemperature": "outside_temperature"
+}
+
+
+def to_hourly(dataframe):
+    # Parse the datetime column, average to hours and cast values to float32
+    dataframe = dataframe.copy()
+    if dataframe["datetime"].dtype == object:
+        dataframe["datetime"] = pd.to_datetime(dataframe["datetime"], dayfirst=True)
+    elif getattr(dataframe["datetime"].dt, "tz", None) is not None:
+        dataframe["datetime"] = dataframe["datetime"].dt.tz_convert("Europe/Moscow").dt.tz_localize(None)
+    dataframe = dataframe.dropna(subset=["datetime"])
+    for name in dataframe.columns:
+        if name != "datetime":
+            dataframe[name] = pd.to_numeric(dataframe[name], errors="coerce")
+    dataframe = dataframe.resample("1h", on="datetime").mean().reset_index()
+    return dataframe.astype({name: "float32" for name in dataframe.columns if name != "datetime"})
+
+
+def normalize_station_data(dataframe):
+    dataframe = dataframe.loc[:, [name for name in dataframe.columns if "Unnamed" not in str(name)]]
+    dataframe = dataframe.dropna(axis=1, how="all").rename(STATION_COLUMNS, axis=1)
+    dataframe = dataframe.loc[:, [name for name in dataframe.columns if name in STATION_COLUMNS.values()]]
+    return to_hourly(dataframe)
+
+
+def partition_path(source, month, dataset_path=DATASET_PATH):
+    return os.path.join(dataset_path, str(source), f"{month}.parquet")
+
+
+def write_partitions(dataframe, source, dataset_path=DATASET_PATH):
+    # Merge an hourly frame into the month partitions of the source.
+    # For an hour present in both, known new values replace the stored ones.
+    months = dataframe["datetime"].dt.strftime("%Y-%m")
+    for month, part in dataframe.groupby(months):
+        path = partition_path(source, month, dataset_path)
+        if isfile(path):
+            part = pd.concat([pd.read_parquet(path), part], ignore_index=True)
+        part = part.groupby("datetime", as_index=False, sort=True).last()
+        part = part.astype({name: "float32" for name in part.columns if name != "datetime"})
+        
+        # Write to a temporary file first, so readers never see a half-written partition
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = path + ".tmp"
+        part.to_parquet(tmp_path, index=False)
+        os.replace(tmp_path, path)
+
+
+@contextmanager
+def dataset_lock(dataset_path=DATASET_PATH):
+    # Serializes writers of the dataset across threads and processes, as merging
+    # into a partition reads it first
+    os.makedirs(dataset_path, exist_ok=True)
+    with open(os.path.join(dataset_path, ".lock"), "w") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+class DatasetAppender():
+    
+    # Collects the hourly frames downloaded by the "now" pipeline (mosecom
+    # pollution, OpenWeatherMap weather, Ostankino meteoprofile) and merges them
+    # into the dataset in batches: when flush_interval seconds passed since the
+    # first pending frame, when max_rows rows are pending, and at exit.
+    # Every hour is stored once, later downloads of an hour replace its known values.
+    
+    def __init__(self, dataset_path=DATASET_PATH, flush_interval=900, max_rows=10000):
+        self.dataset_path = dataset_path
+        self.flush_interval = flush_interval
+        self.max_rows = max_rows
+        self.pending = {}
+        self.pending_rows = 0
+        self.pending_since = None
+        self.lock = threading.Lock()
+        # Runs at exit of the main process and of worker processes alike
+        Finalize(self, self.flush, exitpriority=10)
+    
+    
+    def add(self, source, dataframe):
+        if dataframe is None or dataframe.empty:
+            return
+        with self.lock:
+            self.pending.setdefault(source, []).append(to_hourly(dataframe))
+            self.pending_rows += dataframe.shape[0]
+            if self.pending_since is None:
+                self.pending_since = time.monotonic()
+            is_due = self.pending_rows >= self.max_rows or\
+                time.monotonic() - self.pending_since >= self.flush_interval
+        if is_due:
+            self.flush()
+    
+    
+    def flush(self):
+        with self.lock:
+            pending = self.pending
+            self.pending = {}
+            self.pending_rows = 0
+            self.pending_since = None
+        for source, frames in pending.items():
+            dataframe = pd.concat(frames, ignore_index=True).groupby("datetime", as_index=False, sort=True).last()
+            dataframe = apply_masks(dataframe, validate(dataframe))
+            try:
+                with dataset_lock(self.dataset_path):
+                    write_partitions(dataframe, source, self.dataset_path)
+            except BaseException as e:
+                print(f"Failed to append live data to the dataset for {source} ({e!r})")
+
+
+def has_source(source, dataset_path=DATASET_PATH):
+    return isdir(os.path.join(dataset_path, str(source)))
+
+
+def list_months(source, dataset_path=DATASET_PATH):
+    source_path = os.path.join(dataset_path, str(source))
+    if not isdir(source_path):
+        return []
+    return sorted(name[:-len(".parquet")] for name in os.listdir(source_path) if name.endswith(".parquet"))
+
+
+def read_dataset(source, columns=None, start=None, end=None, dataset_path=DATASET_PATH):
+    # Read only the month partitions overlapping [start, end] and only the requested columns
+    import pyarrow.parquet as pq
+    
+    if not has_source(source, dataset_path):
+        return None
+    
+    months = list_months(source, dataset_path)
+    if start is not None:
+        months = [month for month in months if month >= pd.Timestamp(start).strftime("%Y-%m")]
+    if end is not None:
+        months = [month for month in months if month <= pd.Timestamp(end).strftime("%Y-%m")]
+    
+    parts = []
+    for month in months:
+        path = partition_path(source, month, dataset_path)
+        if columns is None:
+            part_columns = None
+        else:
+            stored_columns = pq.read_schema(path).names
+            part_columns = ["datetime"] + [name for name in columns if name in stored_columns and name != "datetime"]
+        parts.append(pq.read_table(path, columns=part_columns).to_pandas())
+    if not parts:
+        return None
+    
+    dataframe = pd.concat(parts, ignore_index=True)
+    if start is not None:
+        dataframe = dataframe.loc[dataframe["datetime"] >= pd.Timestamp(start)]
+    if end is not None:
+        dataframe = dataframe.loc[dataframe["datetime"] <= pd.Timestamp(end)]
+    return dataframe.reset_index(drop=True)
@@ -18,169 +18,58 @@ import math
 from sklearn.model_selection import train_test_split
 from sklearn.metrics import r2_score, mean_squared_error
 from catboost import CatBoostRegressor
-import statistics
 
 #!c1.8
 pd.set_option("display.max_columns", None)
 
 #!c1.8
+# Hourly station and Ostankino data from the dataset built by ingest.py
+# (run from the repository root)
+import sys
+sys.path.append(".")
+from dataset import read_dataset
+from station_registry import StationRegistry
 
-mapping = {
-    1: "Туристская 2020 год.xlsx",
-    2: "Коптевский бул. 2020 год.xlsx",
-    3: "Останкино 0 2020 год.xlsx",
-    4: "Глебовская 2020 год.xlsx",
-    5: "Спиридоновка ул. 2020 год.xlsx",
-    6: "Шаболовка 2020.xlsx",
-    7: "Академика Анохина 2020.xlsx",
-    8: "Бутлерова 2020.xlsx",
-    9: "Пролетарский проспект 2020.xlsx",
-    10: "Марьино 2020.xlsx"
-}
+station_ids = StationRegistry().ids()
 
-#!c1.8
 data = {}
 
-params = {
-    "skiprows": [1],
-    "engine": "openpyxl"
-}
-
-for station_number, filename in mapping.items():
-    path = "data/stations/" + filename
-    data[station_number] = pd.read_excel(path, **params)
+for station_number in station_ids:
+    data[station_number] = read_dataset(station_number, start="2020-01-01", end="2020-12-31 23:00")
 
+ost_data = read_dataset("ostankino", start="2020-01-01", end="2020-12-31 23:00")
 
 print(data.keys())
 
 #!c1.8
-profiles_dir = "data/ostankino_profile/"
-
-daily_tables = {}
-
-for file in os.scandir(profiles_dir):
-    daily_table = pd.read_table(file.path, skiprows=19, decimal=",")
-    date = file.name[4:12]
-    daily_tables[date] = daily_table
-
-#!c1.8
-ost_profile_data = pd.concat(daily_tables)
-ost_profile_data["data time"] = pd.to_datetime(ost_profile_data["data time"])
-ost_profile_data.drop("Quality", axis=1, inplace = True)
-ost_profile_data.rename({
-    "data time": "datetime",
-    "0": "t_0m",
-    "50": "t_50m",
-    "100": "t_100m",
-    "150": "t_150m",
-    "200": "t_200m",
-    "250": "t_250m",
-    "300": "t_300m",
-    "350": "t_350m",
-    "400": "t_400m",
-    "450": "t_450m",
-    "500": "t_500m",
-    "550": "t_550m",
-    "600": "t_600m",
-    "OutsideTemperature": "outside_temperature"
-}, axis=1, inplace =True)
-ost_profile_data.reset_index(drop=True, inplace=True)
-ost_profile_data = ost_profile_data.resample("20min", on="datetime").mean().reset_index()
-
-#!c1.8
-ost_253_meteo = pd.read_excel("data/ostankino_meteo.xls", skiprows=2, names=["datetime", "253_wind_direction", "253_wind_speed"])
-ost_253_meteo = ost_253_meteo.resample("20min", on="datetime").mean().reset_index()
-
-#!c1.8
-ost_data = pd.merge(ost_profile_data, ost_253_meteo, how="inner", on="datetime")
-
-
-#!c1.8
-# Drop empty cols, rename them, cast datetime to datetime, join with city-level Ostankino data
+# Join with city-level Ostankino data
 for k, v in data.items():
-    v = v.loc[:, [name for name in v.columns if "Unnamed" not in name]]
-    v.dropna(axis=1, how="all", inplace=True)
-    v.rename({
-        "Дата и время": "datetime",
-        "CO": "co",
-        "NO2": "no2",
-        "NO": "no",
-        "PM10": "pm10",
-        "PM2.5": "pm25",
-        "-T-": "temperature",
-        "| V |": "wind_speed",
-        "_V_": "wind_direction",
-        "Давление": "pressure",
-        "Влажность": "humidity",
-        "Осадки": "precipitation"
-    }, axis=1, inplace=True)
-    v["datetime"] = pd.to_datetime(v["datetime"])
-    v = pd.merge(v, ost_data, how="inner", on="datetime")
-    data[k] = v
+    data[k] = pd.merge(v, ost_data, how="inner", on="datetime")
+
 
 #!c1.8
 #clear data
+# Missing and zero pollutant readings, and readings more than 3σ away from
+# the other stations at the same hour, are dropped
+
+from validation import cross_station_mask
 
 pollutants = ["co", "no2", "no", "pm10", "pm25"]
 weather_params = ["temperature", "wind_speed", "wind_direction", "pressure", "humidity", "precipitation"]
-dropped_indexes = {}
 
-for item in pollutants+weather_params:
+outliers = cross_station_mask({k: v.loc[:, ["datetime"] + [c for c in pollutants + weather_params if c in v.columns]]
+                               for k, v in data.items()})
+dropped_indexes = {}
+for item in pollutants:
     dropped_indexes[item] = {}
-    for i in range(1,11):
-        dropped_indexes[item][i] = []
-
-row_count = 26352
-
-for i in range(row_count):
-    if i % 1000 == 0:
-        print("LINE",i)
-
-    for param_name in pollutants+weather_params:
-        tmp_array = []
-        raw_array = []
-        for j in range(1, 11):
-            row = data[j].loc[i]
-            raw_array.append(None)
-            if param_name in row:
-                #print(j,i,param_name,row)
-                if not math.isnan(row[param_name]):
-                    tmp_array.append(row[param_name])
-                    if not(param_name in pollutants and row[param_name] == 0):
-                        raw_array[j-1] = row[param_name]
-            else:
-                #print("ERR",j,i,param_name)
-                pass
-
-        if len(tmp_array)>1:
-            res_std = statistics.stdev(tmp_array)
-            mean_x = statistics.mean(tmp_array)
-        else:
-            res_std = 0
-            if len(tmp_array)>0:
-                mean_x = tmp_array[0]
-            else:
-                mean_x = None
-
-        #print(i,param_name,res_std,mean_x)
-        #print(tmp_array,raw_array)
-
-        i_index = 1
-
-        if not mean_x is None:
-            for item_val in raw_array:
-                if item_val is None or math.isnan(item_val):
-                    dropped_indexes[param_name][i_index].append(i)
-                elif abs(mean_x-item_val) > 3*res_std and param_name != 'wind_direction':
-                    dropped_indexes[param_name][i_index].append(i)
-                    print("RESSTD OUT",param_name,j,i,item_val,mean_x,res_std)
-        else:
-            print("ALL NONE",param_name,j,i)
-            for kk in range(1,11):
-                dropped_indexes[param_name][kk].append(i)
-
-            i_index +=1
-            #if math.isnan(item_val):
+    for i in station_ids:
+        if item not in data[i].columns:
+            dropped_indexes[item][i] = []
+            continue
+        values = data[i][item]
+        is_dropped = values.isna() | (values == 0) | outliers[i][item]
+        dropped_indexes[item][i] = list(data[i].index[is_dropped])
+        print("DROP", item, i, int(outliers[i][item].sum()), "outliers")
 
 
 #!c1.8
@@ -206,7 +95,7 @@ for k, v in data.items():
 dropped_count = 0
 
 for item in pollutants:
-   for i in range(1,11):
+   for i in station_ids:
        if item in data[i]:
         data[i][item].drop(index = dropped_indexes[item][i] , inplace = True)
         dropped_count += len(dropped_indexes[item][i])
@@ -235,11 +124,8 @@ for n, dict_ in data.items():
                 if feature not in list(table.columns):
                     continue
                 col_name = feature + "_prev_" + str(timeshift) + "h"
-                if timeshift == 168:
-                    window = 9
-                else:
-                    window_size = 6
-                col_value = table[feature].rolling(window=window_size).mean().shift(3*timeshift)
+                window_size = 2
+                col_value = table[feature].rolling(window=window_size).mean().shift(timeshift)
                 table[col_name] = col_value
         data[n][pollutant] = table
 
@@ -251,7 +137,7 @@ for n, dict_ in data.items():
         for timeshift in range(1, 25):
             for feature in forecast_features:
                 col_name = feature + "_forecast_" + str(timeshift) + "h"
-                col_value = table[feature].rolling(window=6).mean().shift(-3*timeshift)
+                col_value = table[feature].rolling(window=2).mean().shift(-timeshift)
                 table[col_name] = col_value
         data[n][pollutant] = table
 
@@ -260,7 +146,7 @@ for n, dict_ in data.items():
     for pollutant, table in dict_.items():
         for timeshift in range(1, 25):
             col_name = "target_" + str(timeshift) + "h"
-            col_value = table["pollutant_concentration"].shift(-3*timeshift)
+            col_value = table["pollutant_concentration"].shift(-timeshift)
             table[col_name] = col_value
         data[n][pollutant] = table
 
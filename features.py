@@ -0,0 +1,67 @@
+from lazy import LazyModule
+
+pd = LazyModule("pandas")
+
+# Feature engineering shared by Predictor (inference) and train.py.
+# Rows of the input tables are consecutive hours.
+
+POLLUTANTS = ["co", "no2", "no", "pm10", "pm25"]
+
+HIST_FEATURES = ["temperature", "wind_speed", "wind_direction",
+                 "pressure", "humidity", "precipitation", "pollutant_concentration"]
+
+FORECAST_FEATURES = ["temperature", "wind_speed", "wind_direction",
+                     "pressure", "humidity", "precipitation"]
+
+LAGS = [*range(1, 25)] + [168]
+
+HORIZONS = range(1, 25)
+
+
+def split_by_pollutant(data, pollutants_to_keep=None):
+    # One table per pollutant, with the pollutant renamed to pollutant_concentration
+    # and the other pollutants removed
+    tables = {}
+    for pollutant_name in POLLUTANTS:
+        if pollutants_to_keep is not None and pollutant_name not in pollutants_to_keep:
+            continue
+        if pollutant_name in data.columns:
+            cols_to_remove = [p for p in POLLUTANTS if p in data.columns and p != pollutant_name]
+            data_part = data.drop(cols_to_remove, axis=1)
+            data_part.rename({pollutant_name: "pollutant_concentration"}, axis=1, inplace=True)
+            tables[pollutant_name] = data_part
+    return tables
+
+
+def add_features(table):
+    # Add date and time, historical (lagged) and weather forecast features.
+    # The datetime column becomes the index.
+    table = table.copy()
+    table["month"] = table["datetime"].dt.month
+    table["day"] = table["datetime"].dt.day
+    table["day_of_week"] = table["datetime"].dt.weekday
+    table["hour"] = table["datetime"].dt.hour
+    table.index = pd.Index(table.datetime)
+    table.drop("datetime", axis=1, inplace=True)
+    
+    # New columns are collected first and added at once, which is much faster
+    # than inserting hundreds of columns one by one
+    new_columns = {}
+    for timeshift in LAGS:
+        for feature in HIST_FEATURES:
+            if feature not in table.columns:
+                continue
+            new_columns[feature + "_prev_" + str(timeshift) + "h"] = table[feature].shift(timeshift)
+    
+    for timeshift in HORIZONS:
+        for feature in FORECAST_FEATURES:
+            new_columns[feature + "_forecast_" + str(timeshift) + "h"] = table[feature].shift(-timeshift)
+    
+    return pd.concat([table, pd.DataFrame(new_columns, index=table.index)], axis=1)
+
+
+def add_targets(table):
+    # Pollutant concentration in 1…24 hours
+    targets = {"target_" + str(timeshift) + "h": table["pollutant_concentration"].shift(-timeshift)
+               for timeshift in HORIZONS}
+    return pd.concat([table, pd.DataFrame(targets, index=table.index)], axis=1)
@@ -0,0 +1,159 @@
+import json
+import threading
+from lazy import LazyModule
+from features import POLLUTANTS
+
+np = LazyModule("numpy")
+pd = LazyModule("pandas")
+px = LazyModule("plotly.express")
+go = LazyModule("plotly.graph_objects")
+
+# Points per figure sent to the browser, longer series are downsampled
+MAX_POINTS = 500
+
+COLORS = {"fact": "#EC0E43", "forecast": "#0000A8",
+          "Факт": "#EC0E43", "Прогноз": "#0000A8",
+          "OpenWeatherMap": "#B470AD"}
+
+
+def lttb(x, y, threshold):
+    # Indices of the points kept by Largest-Triangle-Three-Buckets:
+    # the first and last points, and in each bucket between them the point
+    # forming the largest triangle with the previous kept point and the
+    # average of the next bucket.
+    n = len(x)
+    if threshold >= n or threshold < 3:
+        return np.arange(n)
+    
+    edges = np.linspace(1, n - 1, threshold - 1).astype(np.int64)
+    y_filled = np.where(np.isnan(y), np.nanmean(y) if not np.isnan(y).all() else 0, y)
+    
+    indices = np.empty(threshold, dtype=np.int64)
+    indices[0] = 0
+    indices[-1] = n - 1
+    previous = 0
+    for i in range(threshold - 2):
+        start, end = edges[i], edges[i + 1]
+        next_start, next_end = end, edges[i + 2] if i + 2 < len(edges) else n
+        next_x = x[next_start:next_end].mean()
+        next_y = y_filled[next_start:next_end].mean()
+        area = np.abs((x[previous] - next_x) * (y_filled[start:end] - y_filled[previous])
+                      - (x[previous] - x[start:end]) * (next_y - y_filled[previous]))
+        previous = start + int(np.argmax(area))
+        indices[i + 1] = previous
+    
+    return indices
+
+
+def select_range(data, x_range):
+    # Rows inside [start, end] plus one row on each side, so lines reach the edges
+    start, end = pd.Timestamp(x_range[0]), pd.Timestamp(x_range[1])
+    inside = ((data["datetime"] >= start) & (data["datetime"] <= end)).to_numpy()
+    mask = inside.copy()
+    mask[:-1] |= inside[1:]
+    mask[1:] |= inside[:-1]
+    return data.loc[mask]
+
+
+def downsample(data, pollutant, max_points=MAX_POINTS, x_range=None):
+    # LTTB per value_type series, the series share the point budget evenly
+    if x_range is not None:
+        data = data.groupby("value_type", sort=False, group_keys=False).apply(select_range, x_range)
+    series = [group for _, group in data.groupby("value_type", sort=False)]
+    if len(data) <= max_points or not series:
+        return data
+    
+    threshold = max(max_points // len(series), 3)
+    parts = []
+    for group in series:
+        x = group["datetime"].to_numpy().astype("datetime64[ns]").astype(np.int64).astype(np.float64)
+        y = group[pollutant].to_numpy(dtype=np.float64)
+        parts.append(group.iloc[lttb(x, y, threshold)])
+    return pd.concat(parts)
+
+
+def zoom_range(relayout_data):
+    # Visible x range from dcc.Graph relayoutData, None when zoomed out
+    if not relayout_data:
+        return None
+    if "xaxis.range[0]" in relayout_data and "xaxis.range[1]" in relayout_data:
+        return [relayout_data["xaxis.range[0]"], relayout_data["xaxis.range[1]"]]
+    if "xaxis.range" in relayout_data:
+        return relayout_data["xaxis.range"]
+    return None
+
+
+def add_interval(figure, data, pollutant):
+    # Shaded prediction interval when the forecast has <pollutant>_low/_high columns
+    low, high = f"{pollutant}_low", f"{pollutant}_high"
+    if low not in data.columns or high not in data.columns:
+        return
+    band = data.loc[data[low].notna() & data[high].notna()]
+    if band.empty:
+        return
+    figure.add_scatter(x=band["datetime"], y=band[high], mode="lines", line={"width": 0},
+                       showlegend=False, hoverinfo="skip")
+    figure.add_scatter(x=band["datetime"], y=band[low], mode="lines", line={"width": 0},
+                       fill="tonexty", fillcolor="rgba(0, 0, 168, 0.15)", name="Интервал прогноза")
+
+
+def build_figure(data, pollutant, max_points=MAX_POINTS, x_range=None):
+    # Zoomed figures only contain the visible range, at full resolution
+    # if it has fewer than max_points points. A pollutant missing from the data
+    # (e.g. not on the station page right now) gets an empty figure.
+    if pollutant not in data.columns:
+        figure = go.Figure()
+        figure.add_annotation(text="Нет данных", showarrow=False, xref="paper", yref="paper", x=0.5, y=0.5)
+        return figure
+    data = downsample(data, pollutant, max_points, x_range)
+    figure = px.line(data, x="datetime", y=pollutant, color="value_type",
+                     labels={"datetime": "Дата и время", pollutant: f"{pollutant.upper()}, мг/м3",
+                             "value_type": "Значение"},
+                     color_discrete_map=COLORS)
+    add_interval(figure, data, pollutant)
+    # Keep the user's zoom when the figure is replaced
+    figure.update_layout(uirevision=pollutant)
+    if x_range is not None:
+        figure.update_xaxes(range=x_range)
+    return figure
+
+
+class FigureCache():
+    
+    # Serialized figures keyed by (station, date, pollutant). Each entry keeps the
+    # version of the data it was built from, a newer version replaces it.
+    
+    def __init__(self):
+        self.figures = {}
+        self.lock = threading.Lock()
+    
+    
+    def get(self, station_id, date, pollutant, version):
+        with self.lock:
+            entry = self.figures.get((station_id, date, pollutant))
+        if entry is None or entry[0] != version:
+            return None
+        return entry[1]
+    
+    
+    def put(self, station_id, date, pollutant, version, figure_json):
+        with self.lock:
+            current = self.figures.get((station_id, date, pollutant))
+            if current is None or version is None or current[0] is None or current[0] <= version:
+                self.figures[(station_id, date, pollutant)] = (version, figure_json)
+    
+    
+    def fill(self, station_id, date, data, version):
+        # Build the figures of all pollutants in the data, called when a result is computed
+        for pollutant in POLLUTANTS:
+            if pollutant in data.columns:
+                self.put(station_id, date, pollutant, version, build_figure(data, pollutant).to_json())
+    
+    
+    def get_figure(self, station_id, date, pollutant, data, version):
+        # Figure as a dict ready for dcc.Graph, built only on a miss
+        figure_json = self.get(station_id, date, pollutant, version)
+        if figure_json is None:
+            figure_json = build_figure(data, pollutant).to_json()
+            self.put(station_id, date, pollutant, version, figure_json)
+        return json.loads(figure_json)
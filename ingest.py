@@ -0,0 +1,120 @@
+# Converts the raw station archives (xlsx/xls/csv) and the Ostankino profiler files
+# into the hourly Parquet dataset read by training, backtesting and Predictor.
+#
+# python ingest.py [--dataset dataset/]
+
+import os
+import json
+import argparse
+import pandas as pd
+from dataset import DATASET_PATH, PROFILE_COLUMNS, dataset_lock, has_source, normalize_station_data, read_dataset,\
+    to_hourly, write_partitions
+from station_registry import StationRegistry
+from validation import apply_masks, cross_station_mask, quality_report, validate
+
+profile_dirs = ["data/ostankino_profile/", "data/testing_data/mtp5_200_2/", "historical_data/mtp5_200_2/"]
+
+wind_archives = [
+    ("data/ostankino_meteo.xls", 2),
+    ("data/testing_data/Ветер Останкино 253/Ветер Останкино 253.xlsx", 1),
+    ("historical_data/Ветер Останкино 253.xlsx", 1)
+]
+
+
+def read_station_archive(path):
+    # Yearly archives have units in the second row, test exports have one sheet per period
+    skiprows = [1] if path.startswith("data/stations/") else None
+    sheets = pd.read_excel(path, sheet_name=None, skiprows=skiprows)
+    return normalize_station_data(pd.concat(sheets, ignore_index=True))
+
+
+def read_profiles(profiles_dir):
+    daily_tables = []
+    for file in sorted(os.scandir(profiles_dir), key=lambda f: f.name):
+        if not file.name.endswith(".txt"):
+            continue
+        daily_table = pd.read_table(file.path, skiprows=19, decimal=",")
+        daily_tables.append(daily_table.drop("Quality", axis=1, errors="ignore"))
+    profile_data = pd.concat(daily_tables, ignore_index=True).rename(PROFILE_COLUMNS, axis=1)
+    profile_data["datetime"] = pd.to_datetime(profile_data["datetime"], format="%d/%m/%Y %H:%M:%S")
+    return to_hourly(profile_data)
+
+
+def read_wind(path, skiprows):
+    sheets = pd.read_excel(path, sheet_name=None, skiprows=skiprows,
+                           names=["datetime", "253_wind_direction", "253_wind_speed"])
+    return to_hourly(pd.concat(sheets, ignore_index=True))
+
+
+def write_validated(dataframe, source, dataset_path, rejected):
+    # Values failing the range and stuck-sensor checks are written as missing;
+    # the rejected values are counted per source and column
+    masks = validate(dataframe)
+    with dataset_lock(dataset_path):
+        write_partitions(apply_masks(dataframe, masks), source, dataset_path)
+    for check, mask in masks.items():
+        for name, count in mask.sum().items():
+            counts = rejected.setdefault(source, {}).setdefault(name, {})
+            counts[check] = counts.get(check, 0) + int(count)
+
+
+def write_quality_report(sources, rejected, dataset_path):
+    # Per source and column: rows, missing hours, longest gap, values rejected at
+    # ingestion and, for stations, cross-station outliers (not removed from the
+    # dataset, training decides what to drop)
+    frames = {source: read_dataset(source, dataset_path=dataset_path) for source in sources
+              if has_source(source, dataset_path)}
+    stations = {source: frame for source, frame in frames.items() if source != "ostankino"}
+    cross_station = cross_station_mask(stations) if stations else {}
+    report = {}
+    for source, frame in frames.items():
+        masks = {"cross_station": cross_station[source]} if source in cross_station else {}
+        source_report = quality_report(frame, masks)
+        for name, counts in rejected.get(source, {}).items():
+            if name in source_report:
+                source_report[name].update(counts)
+        report[str(source)] = source_report
+    
+    path = os.path.join(dataset_path, "quality_report.json")
+    with open(path, "w") as f:
+        json.dump(report, f, indent=4)
+    print(f"Wrote the quality report to {path}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--dataset", default=DATASET_PATH)
+    args = parser.parse_args()
+    
+    # Archives of a station are written in the registry order, so later
+    # (more recent) exports win on overlaps
+    registry = StationRegistry()
+    rejected = {}
+    for station_id in registry.ids():
+        for path in registry.archives(station_id):
+            if not os.path.exists(path):
+                print(f"{path} is not found, skipping")
+                continue
+            write_validated(read_station_archive(path), station_id, args.dataset, rejected)
+            print(f"Added {path} to station {station_id}")
+        
+        csv_path = f"historical_data/{station_id}.csv"
+        if os.path.exists(csv_path):
+            write_validated(normalize_station_data(pd.read_csv(csv_path)), station_id, args.dataset, rejected)
+            print(f"Added {csv_path} to station {station_id}")
+    
+    for profiles_dir in profile_dirs:
+        if os.path.isdir(profiles_dir):
+            write_validated(read_profiles(profiles_dir), "ostankino", args.dataset, rejected)
+            print(f"Added {profiles_dir} to ostankino")
+    
+    for path, skiprows in wind_archives:
+        if os.path.exists(path):
+            write_validated(read_wind(path, skiprows), "ostankino", args.dataset, rejected)
+            print(f"Added {path} to ostankino")
+    
+    write_quality_report(registry.ids() + ["ostankino"], rejected, args.dataset)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,19 @@
+import importlib
+
+
+class LazyModule():
+    
+    # Stands in for a module and imports it on the first attribute access,
+    # so heavy dependencies do not slow down the start of the app
+    
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+    
+    
+    def __getattr__(self, attr):
+        if attr.startswith("__"):
+            raise AttributeError(attr)
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return getattr(self._module, attr)
@@ -0,0 +1,212 @@
+import sqlite3
+import threading
+from lazy import LazyModule
+from features import POLLUTANTS, HORIZONS
+
+np = LazyModule("numpy")
+pd = LazyModule("pandas")
+
+MONITORING_PATH = "monitoring.sqlite"
+
+# Observations from these sources are compared with the forecasts. OpenWeatherMap
+# air pollution data only stands in for missing observations (see Predictor).
+OBSERVED_SOURCES = ["mosecom", "buffer"]
+
+# Reported per station, pollutant and horizon on /metrics
+METRICS = {
+    "forecast_error_count": "Forecasts compared with observations",
+    "forecast_rmse": "Root mean squared error since the start of monitoring, mg/m3",
+    "forecast_bias": "Mean error (forecast - observation) since the start of monitoring, mg/m3",
+    "forecast_ewma_rmse": "Exponentially weighted root mean squared error, mg/m3",
+    "forecast_ewma_bias": "Exponentially weighted mean error, mg/m3"}
+
+
+def to_hours(datetimes):
+    # Hours since the epoch. "now" results are time zone aware, often with an
+    # object column mixing the zones of the sources.
+    return pd.DatetimeIndex(pd.to_datetime(datetimes, utc=True)).asi8 // (3600 * 10 ** 9)
+
+
+class ForecastMonitor():
+
+    # Compares the issued "now" forecasts with the observations that arrive with
+    # the later refreshes (see Predictor.forecast_listeners).
+    # Every forecast is kept as one float32 (horizons, pollutants) matrix per
+    # station and issue hour until all its horizons are observed. Each observed
+    # hour is compared once with the forecasts issued 1..24 hours before it, and
+    # folded into running sums and exponentially weighted averages of the error
+    # and squared error per station, pollutant and horizon, so the statistics
+    # take constant space however long the monitor runs.
+    # The store is SQLite, so processes writing to the same file share the statistics.
+
+    def __init__(self, path=MONITORING_PATH, alpha=0.05):
+        self.path = path
+        self.alpha = alpha
+        self.horizons = len(HORIZONS)
+        self.lock = threading.Lock()
+        with self.connect() as connection:
+            connection.executescript("""
+                CREATE TABLE IF NOT EXISTS forecasts (
+                    station_id INTEGER NOT NULL,
+                    issued INTEGER NOT NULL,
+                    forecast BLOB NOT NULL,
+                    PRIMARY KEY (station_id, issued));
+                CREATE TABLE IF NOT EXISTS observed (
+                    station_id INTEGER PRIMARY KEY,
+                    last_hour INTEGER NOT NULL);
+                CREATE TABLE IF NOT EXISTS errors (
+                    station_id INTEGER NOT NULL,
+                    pollutant TEXT NOT NULL,
+                    horizon INTEGER NOT NULL,
+                    count INTEGER NOT NULL,
+                    error_sum REAL NOT NULL,
+                    squared_error_sum REAL NOT NULL,
+                    ewma_error REAL NOT NULL,
+                    ewma_squared_error REAL NOT NULL,
+                    PRIMARY KEY (station_id, pollutant, horizon));
+            """)
+
+
+    def connect(self):
+        connection = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        connection.execute("PRAGMA journal_mode=WAL")
+        return connection
+
+
+    def split(self, result):
+        # Observed and forecast hours and (hours, pollutants) values of a "now" result.
+        # The first forecast hour is also repeated as the last "Факт" row, so
+        # observations are the rows before it.
+        is_forecast = (result["value_type"] == "Прогноз").to_numpy()
+        hours = to_hours(result["datetime"])
+        values = np.full((result.shape[0], len(POLLUTANTS)), np.nan)
+        for i, pollutant in enumerate(POLLUTANTS):
+            if pollutant in result.columns:
+                values[:, i] = result[pollutant].to_numpy(dtype=np.float64)
+        if not is_forecast.any():
+            return hours[:0], values[:0], hours[:0], values[:0]
+        first_forecast_hour = hours[is_forecast].min()
+        is_observed = ((result["value_type"] == "Факт").to_numpy()) & (hours < first_forecast_hour)
+        return hours[is_observed], values[is_observed], hours[is_forecast], values[is_forecast]
+
+
+    def consume(self, station_number, date, result):
+        if date != "now":
+            return
+        observed_hours, observations, forecast_hours, forecast_values = self.split(result)
+        if forecast_hours.shape[0] == 0:
+            return
+        # Horizon h of a forecast issued at hour i is for hour i + h
+        issued = int(forecast_hours.min()) - 1
+        forecast = np.full((self.horizons, len(POLLUTANTS)), np.nan, dtype=np.float32)
+        horizons = forecast_hours - issued
+        is_kept = (horizons >= 1) & (horizons <= self.horizons)
+        forecast[horizons[is_kept] - 1] = forecast_values[is_kept]
+
+        with self.lock, self.connect() as connection:
+            connection.execute("BEGIN IMMEDIATE")
+            if result.attrs.get("sources", {}).get("pollution", "mosecom") in OBSERVED_SOURCES:
+                self.compare(connection, station_number, observed_hours, observations)
+            connection.execute("INSERT OR REPLACE INTO forecasts VALUES (?, ?, ?)",
+                               (station_number, issued, forecast.tobytes()))
+            connection.execute("COMMIT")
+
+
+    def compare(self, connection, station_number, observed_hours, observations):
+        row = connection.execute("SELECT last_hour FROM observed WHERE station_id = ?", (station_number,)).fetchone()
+        last_hour = row[0] if row is not None else -1
+        is_new = observed_hours > last_hour
+        if not is_new.any():
+            return
+        order = np.argsort(observed_hours[is_new])
+        observed_hours = observed_hours[is_new][order]
+        observations = observations[is_new][order]
+
+        rows = connection.execute("SELECT issued, forecast FROM forecasts WHERE station_id = ? AND issued >= ?",
+                                  (station_number, int(observed_hours[0]) - self.horizons)).fetchall()
+        if rows:
+            forecasts = {issued: np.frombuffer(forecast, dtype=np.float32).reshape(self.horizons, len(POLLUTANTS))
+                         for issued, forecast in rows}
+            count, error_sum, squared_error_sum, ewma_error, ewma_squared_error = self.load_errors(connection,
+                                                                                                  station_number)
+            horizon_ids = np.arange(self.horizons)
+            for hour, observation in zip(observed_hours, observations):
+                # (horizons, pollutants) errors of the forecasts for this hour, NaN where there is none
+                predicted = np.full((self.horizons, len(POLLUTANTS)), np.nan)
+                for h in horizon_ids:
+                    forecast = forecasts.get(int(hour) - h - 1)
+                    if forecast is not None:
+                        predicted[h] = forecast[h]
+                error = predicted - observation
+                is_known = ~np.isnan(error)
+                error = np.where(is_known, error, 0)
+                is_first = is_known & (count == 0)
+                count += is_known
+                error_sum += error
+                squared_error_sum += error ** 2
+                weight = np.where(is_first, 1, np.where(is_known, self.alpha, 0))
+                ewma_error += weight * (error - ewma_error)
+                ewma_squared_error += weight * (error ** 2 - ewma_squared_error)
+            self.save_errors(connection, station_number, count, error_sum, squared_error_sum,
+                             ewma_error, ewma_squared_error)
+
+        last_hour = int(observed_hours[-1])
+        connection.execute("INSERT INTO observed VALUES (?, ?) ON CONFLICT(station_id) DO UPDATE "
+                           "SET last_hour = excluded.last_hour", (station_number, last_hour))
+        # Forecasts with all horizons observed are no longer needed
+        connection.execute("DELETE FROM forecasts WHERE station_id = ? AND issued <= ?",
+                           (station_number, last_hour - self.horizons))
+
+
+    def load_errors(self, connection, station_number):
+        arrays = [np.zeros((self.horizons, len(POLLUTANTS))) for _ in range(5)]
+        arrays[0] = arrays[0].astype(np.int64)
+        pollutant_index = {pollutant: i for i, pollutant in enumerate(POLLUTANTS)}
+        for pollutant, horizon, *values in connection.execute(
+                "SELECT pollutant, horizon, count, error_sum, squared_error_sum, ewma_error, ewma_squared_error "
+                "FROM errors WHERE station_id = ?", (station_number,)):
+            for array, value in zip(arrays, values):
+                array[horizon - 1, pollutant_index[pollutant]] = value
+        return arrays
+
+
+    def save_errors(self, connection, station_number, count, error_sum, squared_error_sum,
+                    ewma_error, ewma_squared_error):
+        horizon_ids, pollutant_ids = np.nonzero(count)
+        connection.executemany("INSERT OR REPLACE INTO errors VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                               [(station_number, POLLUTANTS[p], int(h) + 1, int(count[h, p]),
+                                 float(error_sum[h, p]), float(squared_error_sum[h, p]),
+                                 float(ewma_error[h, p]), float(ewma_squared_error[h, p]))
+                                for h, p in zip(horizon_ids, pollutant_ids)])
+
+
+    def statistics(self):
+        # [{"station", "pollutant", "horizon", <metric>: value}]
+        with self.connect() as connection:
+            rows = connection.execute("SELECT station_id, pollutant, horizon, count, error_sum, squared_error_sum, "
+                                      "ewma_error, ewma_squared_error FROM errors "
+                                      "ORDER BY station_id, pollutant, horizon").fetchall()
+        result = []
+        for station_id, pollutant, horizon, count, error_sum, squared_error_sum, ewma_error, ewma_squared_error in rows:
+            result.append({"station": station_id,
+                           "pollutant": pollutant,
+                           "horizon": horizon,
+                           "forecast_error_count": count,
+                           "forecast_rmse": (squared_error_sum / count) ** 0.5,
+                           "forecast_bias": error_sum / count,
+                           "forecast_ewma_rmse": max(ewma_squared_error, 0) ** 0.5,
+                           "forecast_ewma_bias": ewma_error})
+        return result
+
+
+    def metrics_text(self):
+        # Prometheus text exposition format
+        statistics = self.statistics()
+        lines = []
+        for metric, description in METRICS.items():
+            lines.append(f"# HELP {metric} {description}")
+            lines.append(f"# TYPE {metric} gauge")
+            for item in statistics:
+                labels = f'station="{item["station"]}",pollutant="{item["pollutant"]}",horizon="{item["horizon"]}"'
+                lines.append(f"{metric}{{{labels}}} {item[metric]:.6g}")
+        return "\n".join(lines) + "\n"
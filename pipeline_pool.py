@@ -0,0 +1,123 @@
+import time
+import threading
+from concurrent.futures import ProcessPoolExecutor
+import profiling
+
+# Predictor of a worker process, created once by init_worker
+worker_predictor = None
+
+
+def init_worker(predictor_options, profiling_options):
+    global worker_predictor
+    from predictor import Predictor
+    
+    profiling.configure(**profiling_options)
+    # Workers only compute results; the main process caches and persists them
+    worker_predictor = Predictor(preload=False, cache_filename=None, **predictor_options)
+
+
+@profiling.profiled("get_data")
+def compute_in_worker(station_id, date):
+    return worker_predictor.compute_forecast(station_id, date)
+
+
+class PipelinePool():
+    
+    # Runs the pipeline for (station, date) in a bounded pool of worker processes,
+    # so Dash callbacks never block on it. A key that is already being computed
+    # is not submitted again: all requests for it share the same future.
+    # With workers=0 the pipeline runs in the calling thread.
+    # on_result(station, date, result, version) is called after a result is stored.
+    # Workers are profiled with profiling_options (see profiling.configure).
+    # "now" results refreshed by scheduler processes into shared_store (see
+    # scheduler.py) are served while fresh instead of computing them again.
+    
+    def __init__(self, predictor, workers=2, predictor_options=None, retry_interval=60, on_result=None,
+                 profiling_options=None, shared_store=None, shared_max_age=3600):
+        self.predictor = predictor
+        self.shared_store = shared_store
+        self.shared_max_age = shared_max_age
+        self.on_result = on_result
+        self.in_flight = {}
+        # Failure times, a failed key is not resubmitted for retry_interval seconds
+        self.failed = {}
+        self.retry_interval = retry_interval
+        self.lock = threading.Lock()
+        if workers:
+            self.executor = ProcessPoolExecutor(max_workers=workers, initializer=init_worker,
+                                                initargs=(predictor_options or {}, profiling_options or {}))
+        else:
+            self.executor = None
+    
+    
+    def get_data(self, station_id, date):
+        # Fresh cached data, or None while the data is being computed
+        key = self.predictor.forecast_key(station_id, date)
+        if not self.predictor.cache.expired(key):
+            return self.predictor.cache.get(key)
+        shared = self.get_shared(station_id, date)
+        if shared is not None:
+            return shared
+        if self.executor is None:
+            return self.predictor.get_data(station_id, date)
+        with self.lock:
+            failed_at = self.failed.get((station_id, date))
+        if failed_at is None or time.time() - failed_at > self.retry_interval:
+            self.submit(station_id, date)
+        return None
+    
+    
+    def get_shared(self, station_id, date):
+        # The listeners of a shared result ran in the scheduler process, so it
+        # is only cached here, until it is shared_max_age old
+        if self.shared_store is None or date != "now":
+            return None
+        shared = self.shared_store.get_result(station_id, date, self.shared_max_age)
+        if shared is None:
+            return None
+        result, age = shared
+        key = self.predictor.forecast_key(station_id, date)
+        self.predictor.cache.add(key, result, max(self.shared_max_age - age, 1))
+        if self.on_result is not None:
+            self.on_result(station_id, date, result, self.predictor.cache.version(key))
+        return result
+    
+    
+    def submit(self, station_id, date):
+        key = (station_id, date)
+        with self.lock:
+            future = self.in_flight.get(key)
+            is_new = future is None
+            if is_new:
+                future = self.executor.submit(compute_in_worker, station_id, date)
+                self.in_flight[key] = future
+        # A finished future runs the callback right away in this thread, and
+        # store() takes the lock
+        if is_new:
+            future.add_done_callback(lambda done, key=key: self.store(key, done))
+        return future
+    
+    
+    def store(self, key, future):
+        station_id, date = key
+        try:
+            result = future.result()
+            cache_key = self.predictor.forecast_key(station_id, date)
+            self.predictor.store_forecast(station_id, date, result)
+            with self.lock:
+                self.failed.pop(key, None)
+            if self.on_result is not None:
+                self.on_result(station_id, date, result, self.predictor.cache.version(cache_key))
+        except BaseException:
+            print(f"Failed to compute data for station {station_id} on date {date}")
+            with self.lock:
+                self.failed[key] = time.time()
+        finally:
+            with self.lock:
+                del self.in_flight[key]
+    
+    
+    def is_failed(self, station_id, date):
+        # True if the last computation failed and no retry is running
+        with self.lock:
+            return (station_id, date) not in self.in_flight and (station_id, date) in self.failed
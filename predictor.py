@@ -1,16 +1,30 @@
 import re
+import copy
+import fcntl
 import json
-import pandas as pd
 import os
 import pickle
+import threading
+import time
 from os.path import isfile
-from numpy import nan
+from math import nan
+from contextlib import contextmanager
 from urllib.request import urlopen
-from datetime import date, datetime, timedelta, timezone
-from pyowm import OWM
-from pyowm.utils import timestamps, formatting
+from datetime import datetime, timedelta, timezone
 from html.parser import HTMLParser
-from catboost import CatBoostRegressor
+from lazy import LazyModule
+from ring_buffer import HourlyRingBuffer
+from circuit_breaker import CircuitBreaker
+from station_registry import REGISTRY_PATH, StationRegistry
+from compiled_model import ObliviousTreeModel, ensemble_step
+from dataset import DATASET_PATH, DatasetAppender, has_source, read_dataset
+from features import POLLUTANTS, HIST_FEATURES, FORECAST_FEATURES, LAGS, HORIZONS, split_by_pollutant, add_features
+from validation import apply_masks, validate
+from profiling import profiled, stage
+
+# pandas, pyowm and catboost are slow to import, so they are loaded on first use
+pd = LazyModule("pandas")
+np = LazyModule("numpy")
 
 class MeteoprofileHTMLParser(HTMLParser):
     
@@ -40,8 +54,8 @@ class MeteoprofileHTMLParser(HTMLParser):
                         self.datetimes.append(datetime)             
     
    
-    def get_data(self):
-        with urlopen("https://mosecom.mos.ru/meteo/profilemery/ostankino/") as url:          
+    def get_data(self, timeout=None):
+        with urlopen("https://mosecom.mos.ru/meteo/profilemery/ostankino/", timeout=timeout) as url:          
             data = url.read().decode()
             self.feed(data)
             
@@ -71,18 +85,34 @@ class MeteoprofileHTMLParser(HTMLParser):
 
 class Cache():
     
-    def __init__(self):
-        
-        self.cache_filename = "app_cache"
+    def __init__(self, cache_filename="app_cache"):
         
-        self.data = {}
+        # With cache_filename=None the cache is kept in memory only
+        self.cache_filename = cache_filename
         
-        if isfile(self.cache_filename):
-            with open(self.cache_filename, "rb") as f:
-                try:
-                    self.data = pickle.load(f)
-                except BaseException:
-                    print("Failed to load cache")
+        # The cache file is read on first access, not at startup
+        self._data = None
+        self.lock = threading.RLock()
+        self.dump_lock = threading.Lock()
+    
+    
+    @property
+    def data(self):
+        with self.lock:
+            if self._data is None:
+                self._data = {}
+                if self.cache_filename is not None and isfile(self.cache_filename):
+                    with open(self.cache_filename, "rb") as f:
+                        try:
+                            self._data = pickle.load(f)
+                        except BaseException:
+                            print("Failed to load cache")
+        return self._data
+    
+    
+    @data.setter
+    def data(self, value):
+        self._data = value
                     
     
     def add(self, key, value, lifetime=0):        
@@ -92,7 +122,8 @@ class Cache():
         else:
             expire_time = datetime.now() + timedelta(days=3650)
         
-        self.data[key] = {"value": value, "expires": expire_time}
+        with self.lock:
+            self.data[key] = {"value": value, "expires": expire_time, "added": datetime.now()}
         self.dump()
     
     
@@ -102,6 +133,13 @@ class Cache():
         return self.data[key]["value"]
     
     
+    def version(self, key):
+        # Time the value was added, identifies the data for derived caches
+        if key not in self.data:
+            return None
+        return self.data[key].get("added")
+    
+    
     def expired(self, key):
         
         now = datetime.now()
@@ -114,49 +152,76 @@ class Cache():
         return True
     
     def dump(self):
-        with open(self.cache_filename, "wb") as f:
-            pickle.dump(self.data, f)
+        # The background preload adds values while requests dump the cache, so a
+        # snapshot taken under the lock is pickled, to a temporary file first.
+        # Dumps run one at a time, so an older snapshot never replaces a newer one.
+        if self.cache_filename is None:
+            return
+        with self.dump_lock:
+            with self.lock:
+                snapshot = dict(self.data)
+            with open(self.cache_filename + ".tmp", "wb") as f:
+                pickle.dump(snapshot, f)
+            os.replace(self.cache_filename + ".tmp", self.cache_filename)
     
     
     def clear(self):
-        self.data = {}
+        with self.lock:
+            self.data = {}
         self.dump()
 
 
 class Predictor():
     
-    def __init__(self):
-        with open("owm_api_key", "r") as f:
-            self.owm_api_key = f.readline().strip()
-        
-        self.mapping = {
-        "pol_data": {
-                1: "https://mosecom.mos.ru/turistskaya/",
-                2: "https://mosecom.mos.ru/koptevskij/",
-                3: "https://mosecom.mos.ru/ostankino-0/",
-                4: "https://mosecom.mos.ru/glebovskaya/",
-                5: "https://mosecom.mos.ru/spiridonovka/",
-                6: "https://mosecom.mos.ru/shabolovka/",
-                7: "https://mosecom.mos.ru/akademika-anoxina/",
-                8: "https://mosecom.mos.ru/butlerova/",
-                9: "https://mosecom.mos.ru/proletarskij-prospekt/",
-                10: "https://mosecom.mos.ru/marino/"
-            },
-        "weather_data": {
-                1: {"lat": 55.856324, "lon": 37.426628},
-                2: {"lat": 55.833222, "lon": 37.525158},
-                3: {"lat": 55.821154, "lon": 37.612592},
-                4: {"lat": 55.811801, "lon": 37.71249},
-                5: {"lat": 55.759354, "lon": 37.595584},
-                6: {"lat": 55.715698, "lon": 37.6052377},
-                7: {"lat": 55.658163, "lon": 37.471434},
-                8: {"lat": 55.649412, "lon": 37.535874},
-                9: {"lat": 55.635129, "lon": 37.658684},
-                10: {"lat": 55.652695, "lon": 37.751502}    
-            }
-        }
+    def __init__(self, fast_start=False, incremental=False, refresh_interval=0, inference_backend="catboost",
+                 preload=True, cache_filename="app_cache", uncertainty_members=0, quantiles=(0.1, 0.9),
+                 registry_path=REGISTRY_PATH, archive=True):
+        self._owm_api_key = None
+        
+        # "catboost" runs CatBoostRegressor.predict, "compiled" evaluates the models
+        # exported to NumPy arrays (see compiled_model.py)
+        self.inference_backend = inference_backend
+        self.compiled_models = {}
+        
+        # With uncertainty_members > 0 every model is also evaluated as a virtual
+        # ensemble of its truncations, and the forecast gets <pollutant>_low and
+        # <pollutant>_high columns with the given quantiles of the members
+        self.uncertainty_members = uncertainty_members
+        self.quantiles = quantiles
+        
+        # Every "now" refresh stores observations in per-station buffers of the last
+        # week of hours, which are kept on disk. In incremental mode "now" data is
+        # refreshed from the buffers instead of rebuilding the whole window.
+        # A buffer is read, updated and saved under the lock of its station (see
+        # station_buffer_lock), shared by threads and processes.
+        self.incremental = incremental
+        self.buffers = {}
+        self.buffer_mtimes = {}
+        self.buffers_path = "station_buffers/"
+        
+        # Upstream sources are called through circuit breakers. When mosecom is down
+        # or over its latency budget, "now" forecasts run in degraded mode on the
+        # station buffer (if its observations are at most max_observation_age hours
+        # old) or on OpenWeatherMap air pollution data. Substitute data is never
+        # stored in the station buffers. The sources used are recorded in
+        # result.attrs["sources"] and result.attrs["mode"] ("primary" or "degraded").
+        # Requests time out after the latency budget of their breaker, so calls
+        # abandoned by a breaker do not hold its threads for long. OpenWeatherMap
+        # air pollution data is only shown next to "now" forecasts, so without it
+        # the forecast is shown alone.
+        self.breakers = {"mosecom": CircuitBreaker("mosecom"),
+                         "meteoprofile": CircuitBreaker("meteoprofile"),
+                         "weather": CircuitBreaker("weather"),
+                         "owm": CircuitBreaker("owm")}
+        self.max_observation_age = 3
         
         self.historical_data_path = "historical_data/"
+        self.dataset_path = DATASET_PATH
+        
+        # Observed hours downloaded from mosecom, OpenWeatherMap and the profiler
+        # are appended to the dataset, so it keeps growing for training and
+        # historical forecasts (see dataset.DatasetAppender)
+        self.archive = DatasetAppender(self.dataset_path) if archive else None
         
         self.supported_pollutants = {
             "co": {"label": "Оксид углерода (CO)", "value": "co"},
@@ -166,37 +231,44 @@ class Predictor():
             "pm10": {"label": "Пыль (PM10)", "value": "pm10"}
         }
         
-        self.station_names = [
-            {"label": "Туристская", "value": 1},
-            {"label": "Коптевский бульвар", "value": 2},
-            {"label": "Останкино 0", "value": 3},
-            {"label": "Глебовская", "value": 4},
-            {"label": "Спиридоновка", "value": 5},
-            {"label": "Шаболовка", "value": 6},
-            {"label": "Академика Анохина", "value": 7},
-            {"label": "Бутлерова", "value": 8},
-            {"label": "Пролетарский проспект", "value": 9},
-            {"label": "Марьино", "value": 10}
-            ]
-        
-        self.available_dates = [{"label": "Сейчас", "value": "now"}] +\
-                               [{"label": date.fromisoformat(value).strftime("%d.%m.%Y"), "value": value}
-                                   for value in
-                                   [
-                                    "2021-01-15", "2021-01-18", "2021-01-19",
-                                    "2021-04-09", "2021-04-13",
-                                    "2021-07-13", "2021-07-14", "2021-07-27",
-                                    "2021-09-13", "2021-09-21"
-                                    ]]
-        
-        self.cache = Cache()
-        
-        self.preload_data()
+        # Stations, their sources and capabilities (see station_registry.py)
+        self.registry = StationRegistry(registry_path)
+        
+        # Called as listener(station_number, date, result) for every stored forecast
+        self.forecast_listeners = []
+        
+        self.cache = Cache(cache_filename)
+        
+        # In fast start mode preloading runs in the background, so the app
+        # can answer requests right away
+        if not preload:
+            self.preload_thread = None
+        elif fast_start:
+            self.preload_thread = threading.Thread(target=self.preload_data, daemon=True)
+            self.preload_thread.start()
+        else:
+            self.preload_thread = None
+            self.preload_data()
+        
+        # Keep the buffers filled from the live sources even when nobody uses the app
+        if refresh_interval:
+            self.refresh_thread = threading.Thread(target=self.refresh_buffers, args=(refresh_interval,), daemon=True)
+            self.refresh_thread.start()
+        else:
+            self.refresh_thread = None
+    
+    
+    @property
+    def owm_api_key(self):
+        if self._owm_api_key is None:
+            with open("owm_api_key", "r") as f:
+                self._owm_api_key = f.readline().strip()
+        return self._owm_api_key
         
     
     def preload_data(self):
         print("Preloading data, please wait…")
-        for station_id in range(1, 11):
+        for station_id in self.registry.ids():
             for date_option in self.get_date_options(station_id):
                 date = date_option["value"]
                 try:
@@ -206,39 +278,122 @@ class Predictor():
                     print(f"Failed to data for station {station_id} on date {date}")
 
         
+    def refresh_buffers(self, interval):
+        # Refresh of all stations in this process, see scheduler.py for running
+        # shards in separate processes or nodes. A store already split by
+        # scheduler.py keeps its shards, each is run in a thread here.
+        from scheduler import CoordinationStore, RefreshScheduler
+        
+        try:
+            store = CoordinationStore()
+            shards = store.shard_count() or 1
+            schedulers = [RefreshScheduler(self, shard, shards, store, interval) for shard in range(shards)]
+        except BaseException as e:
+            print(f"Background refresh is not running ({e!r})")
+            raise
+        for scheduler in schedulers[1:]:
+            threading.Thread(target=scheduler.run, daemon=True).start()
+        schedulers[0].run()
+    
+    
     def get_date_options(self, station_number):
-        options = self.available_dates
-        if station_number == 10:
-            return options[:-1]
-        return options
+        return self.registry.date_options(station_number)
+    
     
     def get_pollutant_options(self, station_number, date):
-        dataframe = self.get_data(station_number, date)
-        cols = dataframe.columns
-        options = []
-        for col in cols:
-            if col in self.supported_pollutants:
-                options.append(self.supported_pollutants[col])
-        return options
+        # Pollutants come from the registry, so listing them does not run the
+        # pipeline. A fresh result drops the ones missing from its data.
+        names = self.registry.pollutants(station_number)
+        key = self.forecast_key(station_number, date)
+        if not self.cache.expired(key):
+            names = [name for name in names if name in self.cache.get(key).columns]
+        return [self.supported_pollutants[name] for name in names if name in self.supported_pollutants]
+    
     
     def get_external_data(self, station_number):
-        pollution_data = self.fetch_pollution_data(station_number)
-        pollution_dataframe = self.pollution_data_to_dataframe(pollution_data)
-        
-        if self.cache.expired("meteoprofile"):
-            meteoprofile_dataframe = MeteoprofileHTMLParser().get_data()
-            self.cache.add("meteoprofile", meteoprofile_dataframe, 3600)
-        else:
-            meteoprofile_dataframe = self.cache.get("meteoprofile")
-        mp_dataframe = pollution_dataframe.merge(meteoprofile_dataframe, how="left", on="datetime")
+        pollution_dataframe, pollution_source = self.get_pollution_data(station_number)
+        meteoprofile_dataframe, meteoprofile_source = self.get_meteoprofile_with_source()
+        with stage("merge"):
+            mp_dataframe = pollution_dataframe.merge(meteoprofile_dataframe, how="left", on="datetime")
         weather_dataframe = self.get_weather_data(station_number)
-        data = weather_dataframe.merge(mp_dataframe, how="left", on="datetime")
+        with stage("merge"):
+            data = weather_dataframe.merge(mp_dataframe, how="left", on="datetime")
+        self.set_sources(data, pollution_source, meteoprofile_source)
         return data
+    
+    
+    def set_sources(self, data, pollution_source, meteoprofile_source):
+        data.attrs["sources"] = {"pollution": pollution_source, "meteoprofile": meteoprofile_source}
+        is_primary = pollution_source == "mosecom" and meteoprofile_source == "mosecom"
+        data.attrs["mode"] = "primary" if is_primary else "degraded"
+    
+    
+    def get_pollution_data(self, station_number):
+        # (pollution dataframe, source): "mosecom", or in degraded mode "buffer" or "owm"
+        try:
+            pollution_data = self.breakers["mosecom"].call(self.fetch_pollution_data, station_number)
+            pollution_dataframe = self.pollution_data_to_dataframe(pollution_data)
+            # Implausible and stuck readings are dropped before they reach the buffers
+            pollution_dataframe = apply_masks(pollution_dataframe, validate(pollution_dataframe))
+            self.archive_data(station_number, pollution_dataframe)
+            return pollution_dataframe, "mosecom"
+        except BaseException as e:
+            print(f"Mosecom data for station {station_number} is unavailable ({e!r}), running in degraded mode")
+        
+        buffer = self.get_station_buffer(station_number)
+        if buffer is not None:
+            pollutants = [p for p in POLLUTANTS if p in buffer.column_index]
+            last_hour = max([buffer.last_valid_hour(p) or -1 for p in pollutants] + [-1])
+            now_hour = buffer.to_hour(pd.Timestamp.now(tz="UTC"))
+            if last_hour >= 0 and now_hour - last_hour <= self.max_observation_age:
+                frame = buffer.to_frame(last_hour - buffer.capacity + 1, last_hour)
+                return frame[["datetime"] + pollutants].dropna(how="all", subset=pollutants), "buffer"
+        
+        station = self.registry.coords(station_number)
+        end = int(time.time())
+        start = end - 8 * 24 * 3600
+        owm_data = self.breakers["owm"].call(self.get_owm_data, station["lat"], station["lon"], "history", start, end)
+        owm_data["datetime"] = owm_data["datetime"].dt.tz_convert("Europe/Moscow")
+        # Only the pollutants measured at the station, as only they have models
+        owm_data = owm_data[["datetime"] + [p for p in self.registry.get(station_number)["pollutants"]
+                                            if p in owm_data.columns]]
+        return owm_data, "owm"
+    
+    
+    def get_meteoprofile(self):
+        return self.get_meteoprofile_with_source()[0]
+    
+    
+    def get_meteoprofile_with_source(self):
+        # When the profiler page is unavailable, the last cached profile is used
+        if not self.cache.expired("meteoprofile"):
+            return self.cache.get("meteoprofile"), "mosecom"
+        try:
+            meteoprofile_dataframe = self.breakers["meteoprofile"].call(
+                lambda: MeteoprofileHTMLParser().get_data(timeout=self.breakers["meteoprofile"].latency_budget))
+            meteoprofile_dataframe = apply_masks(meteoprofile_dataframe, validate(meteoprofile_dataframe))
+        except BaseException as e:
+            if self.cache.get("meteoprofile") is None:
+                raise
+            print(f"Meteoprofile is unavailable ({e!r}), using the cached one")
+            return self.cache.get("meteoprofile"), "cache"
+        self.cache.add("meteoprofile", meteoprofile_dataframe, 3600)
+        self.archive_data("ostankino", meteoprofile_dataframe)
+        return meteoprofile_dataframe, "mosecom"
+    
+    
+    def archive_data(self, source, dataframe):
+        if self.archive is None:
+            return
+        try:
+            self.archive.add(source, dataframe)
+        except BaseException as e:
+            print(f"Failed to archive data for {source} ({e!r})")
 
 
     def fetch_pollution_data(self, station_number):
-        link = self.mapping["pol_data"][station_number]
-        with urlopen(link) as url:
+        link = self.registry.url(station_number)
+        with urlopen(link, timeout=self.breakers["mosecom"].latency_budget) as url:
             page_src = url.read().decode()
             pol_data_src = re.findall("AirCharts.init.*", page_src)[0]
             pol_data_start = len("AirCharts.init(")
@@ -280,16 +435,29 @@ class Predictor():
         return result
 
 
-    def get_weather_data(self, station_number):
-        owm = OWM(self.owm_api_key)
-        mgr = owm.weather_manager()
-        coords = self.mapping["weather_data"][station_number]
-        forecast_data = self.get_weather_forecast(mgr, coords)
-        historical_data = self.get_weather_history(mgr, coords)
-        weather_data = historical_data.append(forecast_data).drop_duplicates(subset="datetime")
+    def get_weather_data(self, station_number, include_yesterday=True):
+        forecast_data, historical_data = self.breakers["weather"].call(self.fetch_weather_data, station_number,
+                                                                       include_yesterday)
+        with stage("append"):
+            weather_data = historical_data.append(forecast_data).drop_duplicates(subset="datetime")
         weather_data["datetime"] = pd.to_datetime(weather_data["datetime"])
+        self.archive_data(station_number,
+                          weather_data.loc[weather_data["datetime"] <= pd.Timestamp.now(tz="Europe/Moscow")])
 
         return weather_data
+    
+    
+    def fetch_weather_data(self, station_number, include_yesterday=True):
+        from pyowm import OWM
+        from pyowm.utils.config import get_default_config
+        
+        config = get_default_config()
+        config["connection"]["timeout_secs"] = self.breakers["weather"].latency_budget
+        mgr = OWM(self.owm_api_key, config).weather_manager()
+        coords = self.registry.coords(station_number)
+        forecast_data = self.get_weather_forecast(mgr, coords)
+        historical_data = self.get_weather_history(mgr, coords, include_yesterday)
+        return forecast_data, historical_data
         
         
     def get_weather_forecast(self, owm_manager, point_coordinates):
@@ -320,13 +488,18 @@ class Predictor():
         result = pd.DataFrame(station_weather_forecast)
         return result
 
-    def get_weather_history(self, owm_manager, point_coordinates):
+    def get_weather_history(self, owm_manager, point_coordinates, include_yesterday=True):
+        from pyowm.utils import timestamps, formatting
+        
         today = int(datetime.now().timestamp())
-        yesterday = formatting.to_UNIXtime(timestamps.yesterday())
-
         owm_station_hist_today = owm_manager.one_call_history(**point_coordinates, dt=today)
-        owm_station_hist_yesterday = owm_manager.one_call_history(**point_coordinates, dt=yesterday)
-        owm_station_hist = owm_station_hist_yesterday.forecast_hourly + owm_station_hist_today.forecast_hourly
+        owm_station_hist = owm_station_hist_today.forecast_hourly
+        
+        # Incremental updates skip yesterday when all its hours are already known
+        if include_yesterday:
+            yesterday = formatting.to_UNIXtime(timestamps.yesterday())
+            owm_station_hist_yesterday = owm_manager.one_call_history(**point_coordinates, dt=yesterday)
+            owm_station_hist = owm_station_hist_yesterday.forecast_hourly + owm_station_hist
         
         station_weather_hist = {
             "datetime": [],
@@ -400,6 +573,18 @@ class Predictor():
     
     
     def load_historical_data(self, station_id, date):
+        start_date = datetime.fromisoformat(date) - timedelta(days=1, hours=12)
+        end_date = datetime.fromisoformat(date) + timedelta(days=1)
+        
+        # Read only the needed hours from the dataset, if it has them. The live
+        # archive creates the dataset sources too, so without ingest.py they only
+        # hold recent hours and older dates are read from the raw archives.
+        if has_source(station_id, self.dataset_path) and has_source("ostankino", self.dataset_path):
+            dataframe = read_dataset(station_id, start=start_date, end=end_date, dataset_path=self.dataset_path)
+            ost_data = read_dataset("ostankino", start=start_date, end=end_date, dataset_path=self.dataset_path)
+            if dataframe is not None and ost_data is not None and not dataframe.empty and not ost_data.empty:
+                with stage("merge"):
+                    return pd.merge(dataframe, ost_data, how="inner", on="datetime")
         
         path = self.historical_data_path + f"{station_id}.csv"
         
@@ -423,60 +608,23 @@ class Predictor():
             "Осадки": "precipitation"
         }, axis=1, inplace=True)
         dataframe.reset_index(drop=True, inplace=True)
-        dataframe = dataframe.resample("1h", on="datetime").mean()
+        dataframe = dataframe.resample("1h", on="datetime").mean().reset_index()
+        dataframe = apply_masks(dataframe, validate(dataframe))
         
         ost_data = self.load_meteoprofiles()
-        dataframe = pd.merge(dataframe, ost_data, how="inner", on="datetime")
+        with stage("merge"):
+            dataframe = pd.merge(dataframe, ost_data, how="inner", on="datetime")
         
-        start_date = datetime.fromisoformat(date) - timedelta(days=1, hours=12)
-        end_date = datetime.fromisoformat(date) + timedelta(days=1)
         dataframe = dataframe.loc[(dataframe["datetime"] >= start_date) & (dataframe["datetime"] <= end_date)]
                 
         return dataframe
 
 
-    def generate_features(self, data, date="now"):
-        # Split by pollutant
-        pollutants = ["co", "no2", "no", "pm10", "pm25"]
-
-        features = {}
-        for pollutant_name in pollutants:
-            if pollutant_name in data.columns:
-                cols_to_remove = [p for p in pollutants if p in data.columns and p != pollutant_name]
-                data_part = data.drop(cols_to_remove, axis=1)
-                data_part.rename({pollutant_name: "pollutant_concentration"}, axis=1,inplace=True)
-                features[pollutant_name] = data_part
+    def generate_features(self, data, date="now", pollutants_to_keep=None):
+        features = split_by_pollutant(data, pollutants_to_keep)
             
         for pollutant_name, table in features.items():
-            table["month"] = table["datetime"].dt.month
-            table["day"] = table["datetime"].dt.day
-            table["day_of_week"] = table["datetime"].dt.weekday
-            table["hour"] = table["datetime"].dt.hour
-            table.index = pd.Index(table.datetime)
-            table.drop("datetime", axis=1, inplace=True)
-        
-
-            # Generate historical features
-            hist_features = ["temperature", "wind_speed", "wind_direction",\
-                                    "pressure", "humidity", "precipitation", "pollutant_concentration"]
-
-            for timeshift in [*range(1, 25)] + [168]:
-                for feature in hist_features:
-                    if feature not in list(table.columns):
-                        continue
-                    col_name = feature + "_prev_" + str(timeshift) + "h"
-                    col_value = table[feature].shift(timeshift)
-                    table[col_name] = col_value
-
-            # Generate forecast features
-            forecast_features = ["temperature", "wind_speed", "wind_direction",\
-                                    "pressure", "humidity", "precipitation"]
-
-            for timeshift in range(1, 25):
-                for feature in forecast_features:
-                    col_name = feature + "_forecast_" + str(timeshift) + "h"
-                    col_value = table[feature].shift(-timeshift)
-                    table[col_name] = col_value
+            table = add_features(table)
             
             # Leave only row with the necessary date
             if date == "now":
@@ -490,6 +638,160 @@ class Predictor():
         return features
 
 
+    def get_station_buffer(self, station_number):
+        # The buffer is reloaded when another process (e.g. a pipeline worker) saved a newer one
+        path = self.buffers_path + f"{station_number}.npz"
+        if isfile(path) and os.path.getmtime(path) > self.buffer_mtimes.get(station_number, 0):
+            try:
+                self.buffers[station_number] = HourlyRingBuffer.load(path)
+                self.buffer_mtimes[station_number] = os.path.getmtime(path)
+            except BaseException:
+                print(f"Failed to load buffer for station {station_number}")
+        return self.buffers.get(station_number)
+    
+    
+    @contextmanager
+    def station_buffer_lock(self, station_number):
+        # Serializes the refreshes of a station's buffer across threads (preload,
+        # background refresh, requests) and processes (pipeline workers,
+        # scheduler.py), so none of them overwrites the hours another one added.
+        # Every call opens the lock file, so threads of one process exclude each
+        # other too.
+        os.makedirs(self.buffers_path, exist_ok=True)
+        with open(self.buffers_path + f"{station_number}.lock", "w") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+    
+    
+    def save_station_buffer(self, station_number):
+        path = self.buffers_path + f"{station_number}.npz"
+        self.buffers[station_number].save(path)
+        self.buffer_mtimes[station_number] = os.path.getmtime(path)
+    
+    
+    def fill_station_buffer(self, station_number, data):
+        # Store observed hours of a freshly built "now" frame and return the
+        # buffer with the forecast hours separately. Substitute pollution data
+        # goes to a copy of the station buffer.
+        if self.get_station_buffer(station_number) is None:
+            columns = [name for name in data.columns if name != "datetime"]
+            self.buffers[station_number] = HourlyRingBuffer(columns)
+        buffer = self.buffers[station_number]
+        if data.attrs.get("sources", {}).get("pollution") == "owm":
+            buffer = copy.deepcopy(buffer)
+        is_observed = data["datetime"] <= pd.Timestamp.now(tz="Europe/Moscow")
+        buffer.update(data.loc[is_observed])
+        
+        forecast_columns = ["datetime", "temperature", "wind_speed", "wind_direction",
+                            "pressure", "humidity", "precipitation"]
+        weather_forecast = HourlyRingBuffer(forecast_columns[1:])
+        weather_forecast.update(data.loc[~is_observed, forecast_columns])
+        return weather_forecast, buffer
+    
+    
+    def update_station_buffer(self, station_number):
+        # Fetch only the hours that are not in the buffer yet
+        buffer = self.buffers[station_number]
+        pollutants = [p for p in POLLUTANTS if p in buffer.column_index]
+        
+        pollution_dataframe, pollution_source = self.get_pollution_data(station_number)
+        if pollution_source == "owm":
+            buffer = copy.deepcopy(buffer)
+        last_pollution_hour = max([buffer.last_valid_hour(p) or -1 for p in pollutants] + [-1])
+        pollution_dataframe = pollution_dataframe.loc[pollution_dataframe["datetime"] >
+                                                      buffer.from_hour(last_pollution_hour)]
+        buffer.update(pollution_dataframe)
+        
+        meteoprofile_dataframe, meteoprofile_source = self.get_meteoprofile_with_source()
+        last_meteoprofile_hour = buffer.last_valid_hour("t_0m") or -1
+        buffer.update(meteoprofile_dataframe.loc[meteoprofile_dataframe["datetime"] >
+                                                 buffer.from_hour(last_meteoprofile_hour)])
+        
+        now_hour = buffer.to_hour(pd.Timestamp.now(tz="UTC"))
+        last_weather_hour = buffer.last_valid_hour("temperature")
+        include_yesterday = last_weather_hour is None or last_weather_hour < (now_hour // 24) * 24
+        weather_dataframe = self.get_weather_data(station_number, include_yesterday)
+        is_observed = weather_dataframe["datetime"] <= pd.Timestamp.now(tz="Europe/Moscow")
+        buffer.update(weather_dataframe.loc[is_observed])
+        
+        weather_forecast = HourlyRingBuffer([name for name in weather_dataframe.columns if name != "datetime"])
+        weather_forecast.update(weather_dataframe.loc[~is_observed])
+        
+        current_data = buffer.to_frame(buffer.last_hour - 47, buffer.last_hour)
+        self.set_sources(current_data, pollution_source, meteoprofile_source)
+        return current_data, weather_forecast, buffer
+    
+    
+    def generate_buffer_features(self, buffer, weather_forecast, pollutants_to_keep=None):
+        # Same features as generate_features(data, "now"), but built only for the
+        # current row with direct lookups into the station buffer. As the buffer keeps
+        # a week of hours, the 168h lags are known too.
+        def value(column, hour):
+            result = buffer.get(column, hour)
+            if result != result:
+                result = weather_forecast.get(column, hour)
+            return result
+        
+        features = {}
+        for pollutant_name in POLLUTANTS:
+            if pollutants_to_keep is not None and pollutant_name not in pollutants_to_keep:
+                continue
+            current_hour = buffer.last_valid_hour(pollutant_name)
+            if current_hour is None:
+                continue
+            
+            sources = {}
+            for column in buffer.columns:
+                if column in POLLUTANTS and column != pollutant_name:
+                    continue
+                if column == pollutant_name:
+                    sources["pollutant_concentration"] = column
+                else:
+                    sources[column] = column
+            
+            row = {name: value(column, current_hour) for name, column in sources.items()}
+            current_datetime = buffer.from_hour(current_hour)
+            row["month"] = current_datetime.month
+            row["day"] = current_datetime.day
+            row["day_of_week"] = current_datetime.weekday()
+            row["hour"] = current_datetime.hour
+            
+            for timeshift in LAGS:
+                for feature in HIST_FEATURES:
+                    if feature not in sources:
+                        continue
+                    row[feature + "_prev_" + str(timeshift) + "h"] = buffer.lag(sources[feature], current_hour, timeshift)
+            
+            for timeshift in HORIZONS:
+                for feature in FORECAST_FEATURES:
+                    row[feature + "_forecast_" + str(timeshift) + "h"] = value(feature, current_hour + timeshift)
+            
+            features[pollutant_name] = pd.DataFrame([row], index=pd.DatetimeIndex([current_datetime], name="datetime"))
+        
+        return features
+
+
+    def get_compiled_model(self, model_path):
+        # Models are exported once and stored next to the .cbm file;
+        # the export is redone when the .cbm file is newer
+        if model_path not in self.compiled_models:
+            compiled_path = model_path[:-len(".cbm")] + ".npz"
+            if isfile(compiled_path) and os.path.getmtime(compiled_path) >= os.path.getmtime(model_path):
+                compiled_model = ObliviousTreeModel.load(compiled_path)
+            else:
+                from catboost import CatBoostRegressor
+                
+                model = CatBoostRegressor()
+                model.load_model(model_path)
+                compiled_model = ObliviousTreeModel.from_catboost(model)
+                compiled_model.save(compiled_path)
+            self.compiled_models[model_path] = compiled_model
+        return self.compiled_models[model_path]
+    
+    
     def get_predictions(self, station_number, data):
         predictions = {}
         now = pd.Timestamp(data[list(data)[0]].index.to_pydatetime()[0])
@@ -498,9 +800,24 @@ class Predictor():
             if not isfile(model_path):
                 print(f"Model for {pollutant_name.upper()} on station {station_number} is not found. Skipping this pollutant.")
                 continue
-            model = CatBoostRegressor()
-            model.load_model(model_path)
-            prediction = model.predict(features)
+            if self.uncertainty_members:
+                members = self.get_ensemble_predictions(model_path, features)
+                members[members < 0] = 0.0
+                # The last member is the full model, i.e. the point forecast
+                predictions[pollutant_name] = members[0, -1]
+                low, high = np.quantile(members[0], self.quantiles, axis=0)
+                predictions[f"{pollutant_name}_low"] = low
+                predictions[f"{pollutant_name}_high"] = high
+                continue
+            if self.inference_backend == "compiled":
+                model = self.get_compiled_model(model_path)
+                prediction = model.predict(model.frame_to_array(features))
+            else:
+                from catboost import CatBoostRegressor
+                
+                model = CatBoostRegressor()
+                model.load_model(model_path)
+                prediction = model.predict(features)
             prediction[prediction < 0] = 0.0
             predictions[pollutant_name] = prediction[0]
         result = pd.DataFrame(predictions)
@@ -508,15 +825,37 @@ class Predictor():
         return result
 
 
+    def get_ensemble_predictions(self, model_path, features):
+        # (rows, members, horizons) virtual ensemble predictions, evaluated in one
+        # pass over the trees by both backends
+        if self.inference_backend == "compiled":
+            model = self.get_compiled_model(model_path)
+            return model.predict_ensemble(model.frame_to_array(features), self.uncertainty_members)
+        
+        from catboost import CatBoostRegressor
+        
+        model = CatBoostRegressor()
+        model.load_model(model_path)
+        step = ensemble_step(model.tree_count_, self.uncertainty_members)
+        stages = list(model.staged_predict(features, eval_period=step))[-self.uncertainty_members:]
+        return np.stack([np.asarray(stage).reshape(len(features), -1) for stage in stages], axis=1)
+    
+    
     def join_history_and_forecast(self, current_data, forecast_data):
-        col_names = forecast_data.columns
+        # Prediction interval columns (<pollutant>_low/_high) only exist in the forecast
+        col_names = [name for name in forecast_data.columns if name in current_data.columns]
         first_forecast_datetime = forecast_data.iat[0, 0]
         current_pollution_data = current_data.loc[current_data["datetime"] < first_forecast_datetime, col_names]
-        current_pollution_data = current_pollution_data.append(forecast_data.iloc[0,])
-        current_pollution_data["value_type"] = "Факт"
-        forecast_data["value_type"] = "Прогноз"
-        result = current_pollution_data.append(forecast_data).reset_index(drop=True)
-        result = result.round({"co": 2, "no": 4, "no2": 4, "pm25": 4, "pm10": 4})
+        with stage("append"):
+            current_pollution_data = current_pollution_data.append(forecast_data.iloc[0,])
+            current_pollution_data["value_type"] = "Факт"
+            forecast_data["value_type"] = "Прогноз"
+            result = current_pollution_data.append(forecast_data).reset_index(drop=True)
+        decimals = {"co": 2, "no": 4, "no2": 4, "pm25": 4, "pm10": 4}
+        for name, digits in list(decimals.items()):
+            decimals[f"{name}_low"] = digits
+            decimals[f"{name}_high"] = digits
+        result = result.round(decimals)
         return result
     
     
@@ -526,12 +865,13 @@ class Predictor():
         elif data_type == "current":
             url = f"http://api.openweathermap.org/data/2.5/air_pollution?lat={lat}&lon={lon}&appid={self.owm_api_key}"
         elif data_type == "history":
-            url = f"http://api.openweathermap.org/data/2.5/air_pollution/history?lat={lat}8&lon={lon}&start={start}&end={end}&appid={self.owm_api_key}"
+            url = f"http://api.openweathermap.org/data/2.5/air_pollution/history?lat={lat}&lon={lon}&start={start}&end={end}&appid={self.owm_api_key}"
         else:
             print("Unrecognized data type")
             return None
         
-        result_string = urlopen(url).read().decode()
+        with urlopen(url, timeout=self.breakers["owm"].latency_budget) as response:
+            result_string = response.read().decode()
         
         result = json.loads(result_string)
         
@@ -562,15 +902,20 @@ class Predictor():
     
     
     def add_openweathermap_data(self, station_id, current_data):
-        station = self.mapping["weather_data"][station_id]
+        station = self.registry.coords(station_id)
         lat = station["lat"]
         lon = station["lon"]
         history_start_date = int(current_data.iat[0, 0].timestamp())
         history_end_date = int(datetime.now().timestamp())
         forecast_end_date = current_data.iat[-1, 0]
         
-        owm_history = self.get_owm_data(lat, lon, "history", history_start_date, history_end_date)
-        owm_forecast = self.get_owm_data(lat, lon)
+        try:
+            owm_history = self.breakers["owm"].call(self.get_owm_data, lat, lon, "history",
+                                                    history_start_date, history_end_date)
+            owm_forecast = self.breakers["owm"].call(self.get_owm_data, lat, lon)
+        except BaseException as e:
+            print(f"OpenWeatherMap air pollution data for station {station_id} is unavailable ({e!r})")
+            return current_data
         
         owm_data = owm_history.append(owm_forecast)
         
@@ -585,30 +930,106 @@ class Predictor():
         return result        
 
 
+    @profiled("get_data")
     def get_data(self, station_number, date="now"):
-        if station_number not in range(1, 11):
-            print("Station number must be between 1 and 10.")
+        return self.get_forecast(station_number, date)
+    
+    
+    def get_forecast(self, station_number, date="now", pollutants=None, horizons=None):
+        # The requested pollutants and forecast hours [1…24]. A fresh full result
+        # is sliced. Otherwise only the models of the requested pollutants run,
+        # and that partial result is cached under its own key and not passed to
+        # the listeners, which only see full results. A model predicts all
+        # horizons in one evaluation, so horizons are always sliced.
+        if station_number not in self.registry:
+            print(f"Station {station_number} is not in the registry.")
             return None
         
-        key = f"{station_number}_{date}"
-        if self.cache.expired(key):
-            if date == "now":        
-                current_data = self.get_external_data(station_number)
-            else:
-                current_data = self.load_historical_data(station_number, date)
+        key = self.forecast_key(station_number, date)
+        if not self.cache.expired(key):
+            return self.slice_forecast(self.cache.get(key), pollutants, horizons)
         
-            features = self.generate_features(current_data, date=date)
-            forecast_data = self.get_predictions(station_number, features)
-            our_data = self.join_history_and_forecast(current_data, forecast_data)
-            if date == "now":
-                result = self.add_openweathermap_data(station_number, our_data)
-            else:
-                result = our_data
-            
-            if date == "now":
-                lifetime = 3600
-            else:
-                lifetime = 0
-            self.cache.add(key, result, lifetime)
+        if pollutants is not None and set(pollutants) >= set(self.registry.pollutants(station_number)):
+            pollutants = None
+        if pollutants is None:
+            result = self.compute_forecast(station_number, date)
+            self.store_forecast(station_number, date, result)
+            return self.slice_forecast(result, None, horizons)
         
-        return self.cache.get(key)
+        subset_key = self.forecast_key(station_number, date, pollutants)
+        if self.cache.expired(subset_key):
+            result = self.compute_forecast(station_number, date, pollutants)
+            self.cache.add(subset_key, result, self.forecast_lifetime(date))
+        return self.slice_forecast(self.cache.get(subset_key), pollutants, horizons)
+    
+    
+    def forecast_key(self, station_number, date="now", pollutants=None):
+        if pollutants is None:
+            return f"{station_number}_{date}"
+        return f"{station_number}_{date}_{'-'.join(sorted(pollutants))}"
+    
+    
+    def forecast_lifetime(self, date):
+        if date == "now":
+            return 3600
+        return 0
+    
+    
+    def store_forecast(self, station_number, date, result):
+        self.cache.add(self.forecast_key(station_number, date), result, self.forecast_lifetime(date))
+        for listener in self.forecast_listeners:
+            try:
+                listener(station_number, date, result)
+            except BaseException:
+                print(f"Forecast listener failed for station {station_number} on date {date}")
+    
+    
+    def compute_forecast(self, station_number, date="now", pollutants=None):
+        # Run the whole pipeline without touching the result cache, with the
+        # models of the given pollutants only
+        if date == "now":
+            with self.station_buffer_lock(station_number):
+                if self.incremental and self.get_station_buffer(station_number) is not None:
+                    current_data, weather_forecast, buffer = self.update_station_buffer(station_number)
+                else:
+                    current_data = self.get_external_data(station_number)
+                    weather_forecast, buffer = self.fill_station_buffer(station_number, current_data)
+                if buffer is self.buffers[station_number]:
+                    self.save_station_buffer(station_number)
+                with stage("generate_features"):
+                    features = self.generate_buffer_features(buffer, weather_forecast, pollutants)
+        else:
+            current_data = self.load_historical_data(station_number, date)
+            with stage("generate_features"):
+                features = self.generate_features(current_data, date, pollutants)
+        
+        forecast_data = self.get_predictions(station_number, features)
+        our_data = self.join_history_and_forecast(current_data, forecast_data)
+        if date == "now":
+            result = self.add_openweathermap_data(station_number, our_data)
+            result.attrs["sources"] = current_data.attrs["sources"]
+            result.attrs["mode"] = current_data.attrs["mode"]
+        else:
+            result = our_data
+            result.attrs["sources"] = {"pollution": "archive", "meteoprofile": "archive"}
+            result.attrs["mode"] = "primary"
+        
+        return result
+    
+    
+    def slice_forecast(self, data, pollutants=None, horizons=None):
+        if pollutants is None and horizons is None:
+            return data
+        result = data
+        if pollutants is not None:
+            cols_to_remove = [column for name in self.supported_pollutants if name not in pollutants
+                              for column in [name, f"{name}_low", f"{name}_high"] if column in data.columns]
+            result = result.drop(cols_to_remove, axis=1)
+        if horizons is not None:
+            forecast_datetimes = result.loc[result["value_type"] == "Прогноз", "datetime"].reset_index(drop=True)
+            keep_datetimes = [forecast_datetimes[h - 1] for h in horizons if 1 <= h <= len(forecast_datetimes)]
+            is_dropped = (result["value_type"] == "Прогноз") & ~result["datetime"].isin(keep_datetimes)
+            if keep_datetimes:
+                is_dropped |= (result["value_type"] == "OpenWeatherMap") & (result["datetime"] > max(keep_datetimes))
+            result = result.loc[~is_dropped].reset_index(drop=True)
+        return result
@@ -0,0 +1,199 @@
+import os
+import sys
+import json
+import time
+import threading
+import functools
+import tracemalloc
+from collections import Counter
+from contextlib import contextmanager
+
+# Opt-in profiling of the app and of its pipeline workers, all output goes to
+# the profiles directory:
+#   sampling_<time>.folded              stacks of all threads between start_sampling() and stop_sampling()
+#   slow/<time>_<name>_<ms>ms.folded    stacks of a call of a profiled() function over the slow threshold
+#   allocations.jsonl                   memory allocated by every stage() call
+# .folded files have one "frame;frame;...;frame count" line per stack, the input
+# of flamegraph.pl and speedscope.
+# Stacks are sampled from a background thread every interval seconds, so the
+# profiled code is not traced; the sampler sleeps when there is nothing to sample.
+# Allocation stats need tracemalloc, which slows down the whole process.
+
+PROFILES_PATH = "profiles/"
+
+settings = {"path": PROFILES_PATH, "slow_threshold": None, "allocations": False, "interval": 0.005}
+
+# Stack counters being filled: "all" while sampling is on, and one per thread
+# in a profiled() call while the slow threshold is set
+targets = {}
+targets_lock = threading.Lock()
+sampler_thread = None
+sampler_wakeup = threading.Event()
+
+allocation_stats = {}
+allocations_lock = threading.Lock()
+
+
+def configure(path=PROFILES_PATH, slow_threshold=None, allocations=False, interval=0.005):
+    # slow_threshold in seconds, None to not capture slow calls
+    settings.update(path=path, slow_threshold=slow_threshold, allocations=allocations, interval=interval)
+    if allocations and not tracemalloc.is_tracing():
+        tracemalloc.start()
+    if slow_threshold is not None:
+        ensure_sampler()
+
+
+def ensure_sampler():
+    global sampler_thread
+    with targets_lock:
+        if sampler_thread is None:
+            sampler_thread = threading.Thread(target=sample_stacks, name="profiler", daemon=True)
+            sampler_thread.start()
+
+
+def frame_name(frame):
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+def folded_stack(frame):
+    names = []
+    while frame is not None:
+        names.append(frame_name(frame))
+        frame = frame.f_back
+    return ";".join(reversed(names))
+
+
+def sample_stacks():
+    own_id = threading.get_ident()
+    while True:
+        with targets_lock:
+            is_idle = not targets
+            if is_idle:
+                sampler_wakeup.clear()
+        if is_idle:
+            sampler_wakeup.wait()
+            continue
+        frames = sys._current_frames()
+        with targets_lock:
+            for thread_id, stacks in targets.items():
+                if thread_id == "all":
+                    for frame_thread_id, frame in frames.items():
+                        if frame_thread_id != own_id:
+                            stacks[folded_stack(frame)] += 1
+                elif thread_id in frames:
+                    stacks[folded_stack(frames[thread_id])] += 1
+        del frames
+        time.sleep(settings["interval"])
+
+
+def add_target(key):
+    stacks = Counter()
+    with targets_lock:
+        targets[key] = stacks
+        sampler_wakeup.set()
+    return stacks
+
+
+def remove_target(key):
+    with targets_lock:
+        return targets.pop(key, None)
+
+
+def write_folded(stacks, filename):
+    path = os.path.join(settings["path"], filename)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + ".tmp", "w", encoding="utf-8") as f:
+        for stack, count in stacks.most_common():
+            f.write(f"{stack} {count}\n")
+    os.replace(path + ".tmp", path)
+    return path
+
+
+def timestamp():
+    return time.strftime("%Y%m%d-%H%M%S") + f"-{time.time_ns() % 10 ** 9 // 10 ** 6:03d}"
+
+
+def is_sampling():
+    with targets_lock:
+        return "all" in targets
+
+
+def start_sampling():
+    ensure_sampler()
+    with targets_lock:
+        if "all" in targets:
+            return False
+    add_target("all")
+    return True
+
+
+def stop_sampling():
+    # Path of the written profile, None if sampling was off
+    stacks = remove_target("all")
+    if stacks is None:
+        return None
+    return write_folded(stacks, f"sampling_{timestamp()}.folded")
+
+
+def profiled(name):
+    # Decorator: a call slower than the slow threshold leaves its sampled stacks in profiles/slow/
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            thread_id = threading.get_ident()
+            with targets_lock:
+                is_tracked = settings["slow_threshold"] is not None and thread_id not in targets
+            if not is_tracked:
+                return func(*args, **kwargs)
+            stacks = add_target(thread_id)
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                duration = time.perf_counter() - start
+                remove_target(thread_id)
+                if duration >= settings["slow_threshold"] and stacks:
+                    filename = f"{timestamp()}_{name}_{duration * 1000:.0f}ms.folded"
+                    path = write_folded(stacks, os.path.join("slow", filename))
+                    print(f"Slow call of {name} took {duration:.3f} s, profile written to {path}")
+        return wrapper
+    return decorator
+
+
+@contextmanager
+def stage(name):
+    # Memory allocated by the block: net change and peak over the start. The peak
+    # is process-wide, so concurrent stages in other threads add to it.
+    if not settings["allocations"] or not tracemalloc.is_tracing():
+        yield
+        return
+    start_memory, _ = tracemalloc.get_traced_memory()
+    tracemalloc.reset_peak()
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        duration = time.perf_counter() - start
+        end_memory, peak_memory = tracemalloc.get_traced_memory()
+        record = {"stage": name,
+                  "time": time.time(),
+                  "pid": os.getpid(),
+                  "duration": duration,
+                  "allocated": end_memory - start_memory,
+                  "peak": max(peak_memory - start_memory, 0)}
+        with allocations_lock:
+            stats = allocation_stats.setdefault(name, {"calls": 0, "duration": 0, "allocated": 0, "max_peak": 0})
+            stats["calls"] += 1
+            stats["duration"] += duration
+            stats["allocated"] += record["allocated"]
+            stats["max_peak"] = max(stats["max_peak"], record["peak"])
+            os.makedirs(settings["path"], exist_ok=True)
+            with open(os.path.join(settings["path"], "allocations.jsonl"), "a") as f:
+                f.write(json.dumps(record) + "\n")
+
+
+def allocation_summary():
+    # {stage: {"calls", "duration", "allocated", "max_peak"}} of this process
+    with allocations_lock:
+        return {name: dict(stats) for name, stats in allocation_stats.items()}
@@ -0,0 +1,124 @@
+import os
+from math import nan
+from lazy import LazyModule
+
+np = LazyModule("numpy")
+pd = LazyModule("pandas")
+
+
+class HourlyRingBuffer():
+    
+    # Keeps the last `capacity` hours of a station's observations in a numpy array.
+    # An hour is stored in the slot (hour number % capacity), so writing or reading
+    # any hour is O(1) and the memory used does not grow over time.
+    # Hour numbers are hours since the Unix epoch (UTC).
+    # The default capacity covers the 168h lag features plus a day of spare hours.
+    
+    def __init__(self, columns, capacity=192):
+        self.columns = list(columns)
+        self.column_index = {name: i for i, name in enumerate(self.columns)}
+        self.capacity = capacity
+        self.values = np.full((capacity, len(self.columns)), nan)
+        self.hours = np.full(capacity, -1, dtype="int64")
+        self.last_hour = -1
+    
+    
+    @staticmethod
+    def to_hour(timestamp):
+        return int(pd.Timestamp(timestamp).value // 3_600_000_000_000)
+    
+    
+    @staticmethod
+    def from_hour(hour):
+        return pd.Timestamp(hour * 3_600_000_000_000, tz="UTC").tz_convert("Europe/Moscow")
+    
+    
+    def add_columns(self, columns):
+        # Columns not in the buffer yet are added, with unknown values
+        new_columns = [name for name in columns if name not in self.column_index]
+        if not new_columns:
+            return
+        for name in new_columns:
+            self.column_index[name] = len(self.columns)
+            self.columns.append(name)
+        self.values = np.concatenate([self.values, np.full((self.capacity, len(new_columns)), nan)], axis=1)
+    
+    
+    def update(self, frame):
+        # Write every known value of the frame into the slots of its hours.
+        # Rows older than the buffer window are ignored. Columns the buffer does
+        # not have yet (e.g. a pollutant missing from the station page at the
+        # first fill) are added.
+        if frame is None or frame.shape[0] == 0:
+            return
+        self.add_columns([name for name in frame.columns if name != "datetime"])
+        hours = pd.DatetimeIndex(frame["datetime"]).asi8 // 3_600_000_000_000
+        newest = max(self.last_hour, int(hours.max()))
+        keep = hours > newest - self.capacity
+        hours = hours[keep]
+        slots = hours % self.capacity
+        
+        # Slots that held an older hour are cleared before reuse
+        stale = self.hours[slots] != hours
+        self.values[slots[stale]] = nan
+        self.hours[slots] = hours
+        
+        for column in frame.columns:
+            if column == "datetime":
+                continue
+            values = pd.to_numeric(frame[column], errors="coerce").to_numpy(dtype="float64")[keep]
+            known = ~np.isnan(values)
+            self.values[slots[known], self.column_index[column]] = values[known]
+        
+        self.last_hour = newest
+    
+    
+    def get(self, column, hour):
+        slot = hour % self.capacity
+        if self.hours[slot] != hour or column not in self.column_index:
+            return nan
+        return self.values[slot, self.column_index[column]]
+    
+    
+    def lag(self, column, hour, timeshift):
+        return self.get(column, hour - timeshift)
+    
+    
+    def last_valid_hour(self, column):
+        # The latest hour with a known value in the column, or None
+        if column not in self.column_index:
+            return None
+        known = (self.hours >= 0) & ~np.isnan(self.values[:, self.column_index[column]])
+        if not known.any():
+            return None
+        return int(self.hours[known].max())
+    
+    
+    def to_frame(self, start_hour, end_hour):
+        hours = np.arange(start_hour, end_hour + 1)
+        slots = hours % self.capacity
+        values = self.values[slots].copy()
+        values[self.hours[slots] != hours] = nan
+        result = pd.DataFrame(values, columns=self.columns)
+        result.insert(0, "datetime", [self.from_hour(int(hour)) for hour in hours])
+        return result
+    
+    
+    def save(self, path):
+        # Write to a temporary file first, so a crash never leaves a broken buffer
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            np.savez(f, values=self.values, hours=self.hours,
+                     columns=np.array(self.columns), last_hour=np.array(self.last_hour))
+        os.replace(tmp_path, path)
+    
+    
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as saved:
+            buffer = cls([str(name) for name in saved["columns"]], capacity=saved["values"].shape[0])
+            buffer.values = saved["values"]
+            buffer.hours = saved["hours"]
+            buffer.last_hour = int(saved["last_hour"])
+        return buffer
@@ -0,0 +1,300 @@
+# Sharded refresh of the "now" data of all registry stations.
+# Stations are split into shards (station id % shards), each shard is refreshed by
+# one process, which may run on any node sharing the coordination store. The store
+# (SQLite here) holds leases, so a station is refreshed by one process at a time,
+# per-host refresh slots, viewer priorities and refresh lag per shard, and the
+# refreshed results, which the app serves (see PipelinePool). The forecast
+# listeners (error monitoring, alerts) run in the process that refreshed the station.
+#
+# python scheduler.py --processes 4            all shards on this node
+# python scheduler.py --shards 8 --shard 3     one shard of a larger deployment
+# python scheduler.py --status                 refresh lag per shard
+# python scheduler.py --processes 8 --reshard  change the shard count of the store
+
+import os
+import time
+import pickle
+import socket
+import sqlite3
+import argparse
+from urllib.parse import urlparse
+from multiprocessing import Process
+from station_registry import StationRegistry
+
+STORE_PATH = "scheduler.sqlite"
+
+OWM_HOST = "api.openweathermap.org"
+
+
+class CoordinationStore():
+
+    def __init__(self, path=STORE_PATH):
+        self.path = path
+        with self.connect() as connection:
+            connection.executescript("""
+                CREATE TABLE IF NOT EXISTS stations (
+                    station_id INTEGER PRIMARY KEY,
+                    shard INTEGER NOT NULL,
+                    last_refresh REAL NOT NULL DEFAULT 0,
+                    failures INTEGER NOT NULL DEFAULT 0,
+                    viewed_until REAL NOT NULL DEFAULT 0,
+                    lease_owner TEXT,
+                    lease_until REAL NOT NULL DEFAULT 0);
+                CREATE TABLE IF NOT EXISTS hosts (
+                    host TEXT PRIMARY KEY,
+                    next_slot REAL NOT NULL);
+                CREATE TABLE IF NOT EXISTS shards (
+                    shard INTEGER PRIMARY KEY,
+                    owner TEXT,
+                    heartbeat REAL NOT NULL DEFAULT 0);
+                CREATE TABLE IF NOT EXISTS settings (
+                    name TEXT PRIMARY KEY,
+                    value);
+                CREATE TABLE IF NOT EXISTS results (
+                    station_id INTEGER NOT NULL,
+                    date TEXT NOT NULL,
+                    computed REAL NOT NULL,
+                    result BLOB NOT NULL,
+                    PRIMARY KEY (station_id, date));
+            """)
+
+
+    def connect(self):
+        # A connection per call, so the store can be shared by threads and processes
+        connection = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        connection.execute("PRAGMA journal_mode=WAL")
+        return connection
+
+
+    def sync_stations(self, station_ids, shards, reshard=False):
+        # Add new stations to their shards. The shard count is fixed when the store
+        # is created, a scheduler with another count is refused rather than moving
+        # the stations of running shards, unless reshard is set.
+        with self.connect() as connection:
+            connection.execute("BEGIN IMMEDIATE")
+            row = connection.execute("SELECT value FROM settings WHERE name = 'shards'").fetchone()
+            if row is not None and row[0] != shards and not reshard:
+                connection.execute("ROLLBACK")
+                raise ValueError(f"The coordination store is split into {row[0]} shards, not {shards}. "
+                                 f"Pass --shards {row[0]}, or --reshard to split it again.")
+            is_resharded = row is None or row[0] != shards
+            connection.execute("INSERT OR REPLACE INTO settings VALUES ('shards', ?)", (shards,))
+            if is_resharded:
+                connection.execute("DELETE FROM shards")
+            for station_id in station_ids:
+                connection.execute("INSERT INTO stations (station_id, shard) VALUES (?, ?) "
+                                   "ON CONFLICT(station_id) DO UPDATE SET shard = excluded.shard "
+                                   "WHERE ?", (station_id, station_id % shards, is_resharded))
+            connection.execute("COMMIT")
+
+
+    def shard_count(self):
+        # Shard count the store was split into, None for a new store
+        with self.connect() as connection:
+            row = connection.execute("SELECT value FROM settings WHERE name = 'shards'").fetchone()
+        return row[0] if row is not None else None
+
+
+    def mark_viewed(self, station_id, seconds=600):
+        # Stations open in the UI are refreshed before the others of their shard
+        with self.connect() as connection:
+            connection.execute("UPDATE stations SET viewed_until = ? WHERE station_id = ?",
+                               (time.time() + seconds, station_id))
+
+
+    def claim(self, shard, owner, interval, lease=600):
+        # Lease the most urgent station of the shard that is due for a refresh:
+        # viewed stations first, then the oldest data
+        now = time.time()
+        with self.connect() as connection:
+            connection.execute("BEGIN IMMEDIATE")
+            connection.execute("INSERT INTO shards (shard, owner, heartbeat) VALUES (?, ?, ?) "
+                               "ON CONFLICT(shard) DO UPDATE SET owner = excluded.owner, heartbeat = excluded.heartbeat",
+                               (shard, owner, now))
+            row = connection.execute("SELECT station_id FROM stations "
+                                     "WHERE shard = ? AND lease_until < ? AND last_refresh < ? "
+                                     "ORDER BY viewed_until > ? DESC, last_refresh ASC LIMIT 1",
+                                     (shard, now, now - interval, now)).fetchone()
+            if row is not None:
+                connection.execute("UPDATE stations SET lease_owner = ?, lease_until = ? WHERE station_id = ?",
+                                   (owner, now + lease, row[0]))
+            connection.execute("COMMIT")
+        return None if row is None else row[0]
+
+
+    def complete(self, station_id, success, retry_after=300):
+        # A failed station is retried after retry_after seconds, not at once
+        with self.connect() as connection:
+            if success:
+                connection.execute("UPDATE stations SET last_refresh = ?, failures = 0, lease_until = 0 "
+                                   "WHERE station_id = ?", (time.time(), station_id))
+            else:
+                connection.execute("UPDATE stations SET failures = failures + 1, lease_until = ? "
+                                   "WHERE station_id = ?", (time.time() + retry_after, station_id))
+
+
+    def acquire_host(self, host, min_interval):
+        # Reserve the next slot of a host, shared by all processes.
+        # Returns the seconds to wait before using it.
+        now = time.time()
+        with self.connect() as connection:
+            connection.execute("BEGIN IMMEDIATE")
+            row = connection.execute("SELECT next_slot FROM hosts WHERE host = ?", (host,)).fetchone()
+            slot = now if row is None else max(now, row[0])
+            connection.execute("INSERT INTO hosts (host, next_slot) VALUES (?, ?) "
+                               "ON CONFLICT(host) DO UPDATE SET next_slot = excluded.next_slot",
+                               (host, slot + min_interval))
+            connection.execute("COMMIT")
+        return slot - now
+
+
+    def put_result(self, station_id, date, result):
+        with self.connect() as connection:
+            connection.execute("INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?)",
+                               (station_id, date, time.time(), pickle.dumps(result)))
+
+
+    def get_result(self, station_id, date, max_age):
+        # (result, age in seconds) of a result computed at most max_age seconds ago, or None
+        now = time.time()
+        with self.connect() as connection:
+            row = connection.execute("SELECT computed, result FROM results "
+                                     "WHERE station_id = ? AND date = ? AND computed > ?",
+                                     (station_id, date, now - max_age)).fetchone()
+        if row is None:
+            return None
+        return pickle.loads(row[1]), now - row[0]
+
+
+    def status(self):
+        # {shard: {...}}, lag is the age of the oldest refreshed data in the shard
+        now = time.time()
+        with self.connect() as connection:
+            rows = connection.execute("SELECT s.shard, COUNT(*), MIN(s.last_refresh), SUM(s.failures > 0), "
+                                      "h.owner, h.heartbeat FROM stations s "
+                                      "LEFT JOIN shards h ON h.shard = s.shard GROUP BY s.shard").fetchall()
+        result = {}
+        for shard, stations, oldest_refresh, failing, owner, heartbeat in rows:
+            result[shard] = {"stations": stations,
+                             "lag": now - oldest_refresh if oldest_refresh else None,
+                             "failing": failing,
+                             "owner": owner,
+                             "heartbeat_age": now - heartbeat if heartbeat else None}
+        return result
+
+
+class RefreshScheduler():
+
+    # Refreshes the stations of one shard: every station at most once per interval.
+    # Across all processes using the store, refreshes that call an upstream host
+    # start at least host_interval seconds apart. A refresh makes a few requests
+    # to each host (pollution page and profiler on mosecom; weather forecast,
+    # history and, in degraded mode, air pollution on OpenWeatherMap), so this
+    # bounds the rate of request bursts, not of single requests.
+
+    def __init__(self, predictor, shard=0, shards=1, store=None, interval=3600, host_interval=2, idle_sleep=10,
+                 reshard=False):
+        self.predictor = predictor
+        self.shard = shard
+        self.shards = shards
+        self.store = store if store is not None else CoordinationStore()
+        self.interval = interval
+        self.host_interval = host_interval
+        self.idle_sleep = idle_sleep
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{shard}"
+        self.store.sync_stations(self.predictor.registry.ids(), shards, reshard)
+
+
+    def hosts(self, station_id):
+        return [urlparse(self.predictor.registry.url(station_id)).netloc, OWM_HOST]
+
+
+    def refresh(self, station_id):
+        for host in self.hosts(station_id):
+            wait = self.store.acquire_host(host, self.host_interval)
+            if wait > 0:
+                time.sleep(wait)
+        result = self.predictor.compute_forecast(station_id, "now")
+        self.predictor.store_forecast(station_id, "now", result)
+        self.store.put_result(station_id, "now", result)
+
+
+    def run_once(self):
+        # Refresh one due station, False if none is due
+        station_id = self.store.claim(self.shard, self.owner, self.interval)
+        if station_id is None:
+            return False
+        try:
+            self.refresh(station_id)
+            self.store.complete(station_id, True)
+        except BaseException:
+            print(f"Failed to refresh data for station {station_id}")
+            self.store.complete(station_id, False)
+        return True
+
+
+    def run(self):
+        while True:
+            if not self.run_once():
+                time.sleep(self.idle_sleep)
+
+
+def run_shard(shard, shards, store_path, interval, host_interval, monitoring_path, alerts_file, alert_webhook):
+    from predictor import Predictor
+    from monitoring import ForecastMonitor
+    from alerts import AlertEngine, FileSink, WebhookSink
+
+    # The processes share station buffers on disk and results through the store,
+    # but not the result cache file
+    predictor = Predictor(preload=False, cache_filename=None, incremental=True)
+    predictor.forecast_listeners.append(ForecastMonitor(monitoring_path).consume)
+    if alerts_file or alert_webhook:
+        sinks = []
+        if alerts_file:
+            sinks.append(FileSink(alerts_file))
+        if alert_webhook:
+            sinks.append(WebhookSink(alert_webhook))
+        predictor.forecast_listeners.append(AlertEngine(sinks=sinks).consume)
+    RefreshScheduler(predictor, shard, shards, CoordinationStore(store_path), interval, host_interval).run()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--shards", type=int, help="Total shards, defaults to --processes")
+    parser.add_argument("--shard", type=int, nargs="+", help="Shards to run here, defaults to all")
+    parser.add_argument("--processes", type=int, default=1)
+    parser.add_argument("--store", default=STORE_PATH)
+    parser.add_argument("--interval", type=int, default=3600, help="Seconds between refreshes of a station")
+    parser.add_argument("--host-interval", type=float, default=2,
+                        help="Seconds between station refreshes calling one host")
+    parser.add_argument("--monitoring-store", default="monitoring.sqlite",
+                        help="Forecast error statistics, the app serves them from the same file")
+    parser.add_argument("--alerts-file", default=None,
+                        help="Evaluate exceedance alerts on every refresh and append them to this file")
+    parser.add_argument("--alert-webhook", default=None,
+                        help="Also POST exceedance alerts to this URL")
+    parser.add_argument("--status", action="store_true", help="Print refresh lag per shard and exit")
+    parser.add_argument("--reshard", action="store_true",
+                        help="Split the stations into --shards shards when the store has another count")
+    args = parser.parse_args()
+
+    if args.status:
+        for shard, info in sorted(CoordinationStore(args.store).status().items()):
+            lag = "never refreshed" if info["lag"] is None else f"lag {info['lag']:.0f} s"
+            print(f"Shard {shard}: {info['stations']} stations, {lag}, {info['failing']} failing, owner {info['owner']}")
+        return
+
+    shards = args.shards or args.processes
+    CoordinationStore(args.store).sync_stations(StationRegistry().ids(), shards, args.reshard)
+    shard_ids = args.shard if args.shard is not None else list(range(shards))
+    processes = [Process(target=run_shard, args=(shard, shards, args.store, args.interval, args.host_interval,
+                                                 args.monitoring_store, args.alerts_file, args.alert_webhook))
+                 for shard in shard_ids]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+import json
+from os.path import isfile
+from datetime import date
+
+REGISTRY_PATH = "stations.json"
+MODELS_PATH = "pretrained_models/"
+
+
+class StationRegistry():
+
+    # Stations and their metadata from stations.json: name, coordinates, mosecom
+    # page, measured pollutants, data sources, raw archives and the dates with
+    # historical forecasts (the shared "dates" unless a station lists its own).
+    # Everything that loops over stations takes them from here.
+
+    def __init__(self, path=REGISTRY_PATH, models_path=MODELS_PATH):
+        self.path = path
+        self.models_path = models_path
+        with open(path, "r", encoding="utf-8") as f:
+            registry = json.load(f)
+        self.default_dates = registry["dates"]
+        self.stations = {station["id"]: station for station in registry["stations"]}
+
+
+    def __contains__(self, station_id):
+        return station_id in self.stations
+
+
+    def __len__(self):
+        return len(self.stations)
+
+
+    def ids(self):
+        return list(self.stations)
+
+
+    def get(self, station_id):
+        return self.stations[station_id]
+
+
+    def name(self, station_id):
+        return self.stations[station_id]["name"]
+
+
+    def coords(self, station_id):
+        station = self.stations[station_id]
+        return {"lat": station["lat"], "lon": station["lon"]}
+
+
+    def url(self, station_id):
+        return self.stations[station_id]["url"]
+
+
+    def archives(self, station_id):
+        return self.stations[station_id].get("archives", [])
+
+
+    def dates(self, station_id):
+        return self.stations[station_id].get("dates", self.default_dates)
+
+
+    def pollutants(self, station_id):
+        # Pollutants the station measures and there is a pretrained model for
+        return [pollutant_name for pollutant_name in self.stations[station_id]["pollutants"]
+                if isfile(self.models_path + f"{station_id}_{pollutant_name}.cbm")]
+
+
+    def options(self):
+        # Dropdown options
+        return [{"label": station["name"], "value": station_id} for station_id, station in self.stations.items()]
+
+
+    def date_options(self, station_id):
+        return [{"label": "Сейчас", "value": "now"}] +\
+               [{"label": date.fromisoformat(value).strftime("%d.%m.%Y"), "value": value}
+                for value in self.dates(station_id)]
+
+
+    def nearest(self, lat, lon):
+        return min(self.stations, key=lambda station_id: (self.stations[station_id]["lat"] - lat) ** 2 +
+                                                           (self.stations[station_id]["lon"] - lon) ** 2)
@@ -0,0 +1,174 @@
+# Trains the forecasting models from the hourly dataset built by ingest.py.
+# Features are built month by month (with 168 h of history and 24 h of future around
+# every month) and written to disk, then the models are trained from these partitions
+# through a float32 memory-mapped matrix. Peak memory depends on the month size and
+# the number of training rows, not on how many years the archive covers.
+#
+# python train.py --stations 1 2 --pollutants co no2 [--start 2020-01] [--end 2020-12] [--save]
+
+import os
+import argparse
+import numpy as np
+import pandas as pd
+from catboost import CatBoostRegressor, Pool
+from dataset import DATASET_PATH, list_months, read_dataset
+from features import POLLUTANTS, LAGS, HORIZONS, split_by_pollutant, add_features, add_targets
+from station_registry import StationRegistry
+
+FEATURES_PATH = "features/"
+
+catboost_params = {
+    "iterations": 100,
+    "verbose": 100,
+    "learning_rate": 1,
+    "depth": 8,
+    "loss_function": "MultiRMSE"}
+
+
+def read_chunk(station_id, start, end, dataset_path=DATASET_PATH):
+    station_data = read_dataset(station_id, start=start, end=end, dataset_path=dataset_path)
+    ost_data = read_dataset("ostankino", start=start, end=end, dataset_path=dataset_path)
+    if station_data is None or ost_data is None:
+        return None
+    data = pd.merge(station_data, ost_data, how="inner", on="datetime")
+    if data.empty:
+        return None
+    # Lags are row shifts, so missing hours are added back as empty rows
+    return data.set_index("datetime").asfreq("1h").reset_index()
+
+
+def feature_partitions_dir(station_id, pollutant_name, features_path=FEATURES_PATH):
+    return os.path.join(features_path, f"{station_id}_{pollutant_name}")
+
+
+def build_feature_partitions(station_id, months, dataset_path=DATASET_PATH, features_path=FEATURES_PATH):
+    history = pd.Timedelta(hours=max(LAGS))
+    future = pd.Timedelta(hours=max(HORIZONS))
+    target_names = ["target_" + str(timeshift) + "h" for timeshift in HORIZONS]
+    
+    for month in months:
+        month_start = pd.Timestamp(month + "-01")
+        month_end = month_start + pd.offsets.MonthBegin(1) - pd.Timedelta(hours=1)
+        data = read_chunk(station_id, month_start - history, month_end + future, dataset_path)
+        if data is None:
+            continue
+        
+        for pollutant_name, table in split_by_pollutant(data).items():
+            table = add_targets(add_features(table))
+            table = table.loc[month_start:month_end].dropna(subset=target_names)
+            if table.empty:
+                continue
+            table = table.astype("float32").reset_index()
+            
+            partitions_dir = feature_partitions_dir(station_id, pollutant_name, features_path)
+            os.makedirs(partitions_dir, exist_ok=True)
+            path = os.path.join(partitions_dir, f"{month}.parquet")
+            table.to_parquet(path + ".tmp", index=False)
+            os.replace(path + ".tmp", path)
+        print(f"Built features for station {station_id}, {month}")
+
+
+def load_training_data(station_id, pollutant_name, features_path=FEATURES_PATH):
+    # Copy the feature partitions one by one into a float32 memory-mapped matrix
+    import pyarrow.parquet as pq
+    
+    partitions_dir = feature_partitions_dir(station_id, pollutant_name, features_path)
+    if not os.path.isdir(partitions_dir):
+        return None
+    paths = sorted(os.path.join(partitions_dir, name) for name in os.listdir(partitions_dir)
+                   if name.endswith(".parquet"))
+    if not paths:
+        return None
+    
+    columns = pq.read_schema(paths[0]).names
+    target_names = [name for name in columns if name.startswith("target_")]
+    feature_names = [name for name in columns if name not in target_names and name != "datetime"]
+    n_rows = sum(pq.read_metadata(path).num_rows for path in paths)
+    
+    # Written next to X.npy and renamed when complete, so X.npy is never partial
+    X_path = os.path.join(partitions_dir, "X.npy")
+    X = np.lib.format.open_memmap(X_path + ".tmp", mode="w+",
+                                  dtype="float32", shape=(n_rows, len(feature_names)))
+    y = np.empty((n_rows, len(target_names)), dtype="float32")
+    datetimes = []
+    row = 0
+    for path in paths:
+        part = pd.read_parquet(path).reindex(columns=columns)
+        X[row:row + part.shape[0]] = part[feature_names].to_numpy(dtype="float32")
+        y[row:row + part.shape[0]] = part[target_names].to_numpy(dtype="float32")
+        datetimes.append(part["datetime"])
+        row += part.shape[0]
+    X.flush()
+    os.replace(X_path + ".tmp", X_path)
+    
+    return {"X": X, "y": y, "feature_names": feature_names,
+            "datetime": pd.concat(datetimes, ignore_index=True)}
+
+
+def time_split(data, test_size=0.2):
+    # The last part of the period is held out, so the test set is never older than the training set
+    split = int(data["X"].shape[0] * (1 - test_size))
+    return split
+
+
+def evaluate(y_true, predictions):
+    errors = predictions - y_true
+    rmse = np.sqrt(np.mean(errors ** 2, axis=0))
+    r2 = 1 - np.sum(errors ** 2, axis=0) / np.sum((y_true - y_true.mean(axis=0)) ** 2, axis=0)
+    return pd.DataFrame({"rmse": rmse, "r2": r2}, index=pd.Index(HORIZONS, name="horizon"))
+
+
+def train_model(station_id, pollutant_name, params=catboost_params, test_size=0.2, features_path=FEATURES_PATH):
+    data = load_training_data(station_id, pollutant_name, features_path)
+    if data is None:
+        print(f"No features for {pollutant_name} on station {station_id}, skipping.")
+        return None, None
+    split = time_split(data, test_size)
+    
+    train_pool = Pool(data["X"][:split], data["y"][:split], feature_names=data["feature_names"])
+    # Quantized pools keep one byte per value instead of four
+    train_pool.quantize()
+    model = CatBoostRegressor(**dict(params, allow_writing_files=False))
+    model.fit(train_pool)
+    
+    predictions = model.predict(Pool(data["X"][split:], feature_names=data["feature_names"]))
+    predictions[predictions < 0] = 0
+    metrics = evaluate(data["y"][split:], predictions)
+    return model, metrics
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--stations", type=int, nargs="+", default=StationRegistry().ids())
+    parser.add_argument("--pollutants", nargs="+", default=POLLUTANTS)
+    parser.add_argument("--start", help="First month, YYYY-MM")
+    parser.add_argument("--end", help="Last month, YYYY-MM")
+    parser.add_argument("--dataset", default=DATASET_PATH)
+    parser.add_argument("--features", default=FEATURES_PATH)
+    parser.add_argument("--skip-features", action="store_true", help="Train from existing feature partitions")
+    parser.add_argument("--iterations", type=int, default=catboost_params["iterations"])
+    parser.add_argument("--depth", type=int, default=catboost_params["depth"])
+    parser.add_argument("--save", action="store_true", help="Save models to pretrained_models/")
+    args = parser.parse_args()
+    
+    params = dict(catboost_params, iterations=args.iterations, depth=args.depth)
+    
+    for station_id in args.stations:
+        if not args.skip_features:
+            months = [month for month in list_months(station_id, args.dataset)
+                      if (args.start is None or month >= args.start) and (args.end is None or month <= args.end)]
+            build_feature_partitions(station_id, months, args.dataset, args.features)
+        
+        for pollutant_name in args.pollutants:
+            model, metrics = train_model(station_id, pollutant_name, params, features_path=args.features)
+            if model is None:
+                continue
+            print(f"Station {station_id}, {pollutant_name}: mean RMSE {metrics['rmse'].mean():.4f}, "
+                  f"mean R2 {metrics['r2'].mean():.3f}")
+            if args.save:
+                os.makedirs("pretrained_models", exist_ok=True)
+                model.save_model(f"pretrained_models/{station_id}_{pollutant_name}.cbm")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,276 @@
+# Hyperparameter search for the forecasting models.
+# The feature matrix of every station/pollutant is materialized once as memory-mapped
+# arrays next to its feature partitions (see train.py), and worker processes read
+# it through the page cache. Every worker still builds its own CatBoost pools from
+# it, which peaks at about twice the size of X.npy per worker, so fewer workers
+# than --jobs run when they would not fit in --memory (multidimensional targets
+# rule out sharing one saved quantized pool).
+# Configurations are searched with successive halving: all sampled configurations
+# get a small iteration budget, the best third get three times more, and so on.
+# Every fit early-stops on the held-out last part of the period. Trials are
+# recorded in SQLite, so an interrupted search resumes where it stopped.
+#
+# python tune.py --stations 1 2 --pollutants co no2 [--configs 27] [--jobs 4] [--memory 16] [--save]
+
+import os
+import json
+import math
+import time
+import random
+import sqlite3
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
+from catboost import CatBoostRegressor, Pool
+from features import POLLUTANTS
+from station_registry import StationRegistry
+from train import FEATURES_PATH, catboost_params, feature_partitions_dir, load_training_data, time_split
+
+TRIALS_PATH = "tuning.sqlite"
+
+# Sampled independently for every configuration
+search_space = {
+    "depth": lambda rng: rng.randint(4, 10),
+    "learning_rate": lambda rng: math.exp(rng.uniform(math.log(0.01), math.log(1))),
+    "l2_leaf_reg": lambda rng: math.exp(rng.uniform(math.log(1), math.log(30))),
+    "random_strength": lambda rng: rng.uniform(0.5, 2),
+    "bagging_temperature": lambda rng: rng.uniform(0, 1)}
+
+
+class TrialStore():
+
+    def __init__(self, path=TRIALS_PATH):
+        self.path = path
+        with self.connect() as connection:
+            connection.execute("""
+                CREATE TABLE IF NOT EXISTS trials (
+                    station_id INTEGER NOT NULL,
+                    pollutant TEXT NOT NULL,
+                    config_id INTEGER NOT NULL,
+                    iterations INTEGER NOT NULL,
+                    params TEXT NOT NULL,
+                    score REAL,
+                    best_iteration INTEGER,
+                    duration REAL,
+                    PRIMARY KEY (station_id, pollutant, config_id, iterations))""")
+
+
+    def connect(self):
+        return sqlite3.connect(self.path, timeout=30)
+
+
+    def get(self, station_id, pollutant_name, config_id, iterations):
+        with self.connect() as connection:
+            row = connection.execute("SELECT score, best_iteration FROM trials WHERE station_id = ? AND pollutant = ? "
+                                     "AND config_id = ? AND iterations = ?",
+                                     (station_id, pollutant_name, config_id, iterations)).fetchone()
+        return row
+
+
+    def add(self, station_id, pollutant_name, config_id, iterations, params, score, best_iteration, duration):
+        with self.connect() as connection:
+            connection.execute("INSERT OR REPLACE INTO trials VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                               (station_id, pollutant_name, config_id, iterations, json.dumps(params),
+                                score, best_iteration, duration))
+
+
+    def best(self, station_id, pollutant_name):
+        # (params, score, best_iteration) of the best trial at the largest budget tried
+        with self.connect() as connection:
+            row = connection.execute("SELECT params, score, best_iteration FROM trials "
+                                     "WHERE station_id = ? AND pollutant = ? AND score IS NOT NULL "
+                                     "ORDER BY iterations DESC, score ASC LIMIT 1",
+                                     (station_id, pollutant_name)).fetchone()
+        if row is None:
+            return None
+        return json.loads(row[0]), row[1], row[2]
+
+
+def matrices_match(partitions_dir, meta_path):
+    # X.npy and y.npy have the rows and features recorded in meta.json
+    try:
+        with open(meta_path, "r") as f:
+            meta = json.load(f)
+        X = np.load(os.path.join(partitions_dir, "X.npy"), mmap_mode="r")
+        y = np.load(os.path.join(partitions_dir, "y.npy"), mmap_mode="r")
+    except (OSError, ValueError):
+        return False
+    return X.shape == (meta.get("rows"), len(meta["feature_names"])) and y.shape[0] == X.shape[0]
+
+
+def materialize(station_id, pollutant_name, features_path=FEATURES_PATH):
+    # X.npy (written by load_training_data), y.npy and meta.json; rebuilt when a
+    # feature partition is newer than meta.json or the files do not match.
+    # Every file is renamed into place when complete and meta.json is written
+    # last, so an interrupted build is redone.
+    partitions_dir = feature_partitions_dir(station_id, pollutant_name, features_path)
+    if not os.path.isdir(partitions_dir):
+        return None
+    meta_path = os.path.join(partitions_dir, "meta.json")
+    partitions = [os.path.join(partitions_dir, name) for name in os.listdir(partitions_dir) if name.endswith(".parquet")]
+    if not partitions:
+        return None
+    if not os.path.exists(meta_path) or max(map(os.path.getmtime, partitions)) > os.path.getmtime(meta_path) or\
+            not matrices_match(partitions_dir, meta_path):
+        data = load_training_data(station_id, pollutant_name, features_path)
+        y_path = os.path.join(partitions_dir, "y.npy")
+        with open(y_path + ".tmp", "wb") as f:
+            np.save(f, data["y"])
+        os.replace(y_path + ".tmp", y_path)
+        with open(meta_path + ".tmp", "w") as f:
+            json.dump({"feature_names": data["feature_names"], "rows": int(data["X"].shape[0]),
+                       "split": time_split(data)}, f)
+        os.replace(meta_path + ".tmp", meta_path)
+        if not matrices_match(partitions_dir, meta_path):
+            raise ValueError(f"Feature matrices in {partitions_dir} do not match, were they rebuilt concurrently?")
+    return partitions_dir
+
+
+# Pools of the current worker process, quantized once per model. Every model is
+# searched by a pool of workers of its own, so only the pools of one are kept.
+worker_pools = {}
+
+
+def load_matrices(partitions_dir):
+    with open(os.path.join(partitions_dir, "meta.json"), "r") as f:
+        meta = json.load(f)
+    X = np.load(os.path.join(partitions_dir, "X.npy"), mmap_mode="r")
+    y = np.load(os.path.join(partitions_dir, "y.npy"), mmap_mode="r")
+    return X, y, meta
+
+
+def worker_memory(partitions_dir):
+    # Peak bytes of a worker building the pools: CatBoost copies the rows before
+    # quantizing them, and keeps the held-out rows unquantized
+    return 2 * os.path.getsize(os.path.join(partitions_dir, "X.npy"))
+
+
+def available_memory():
+    return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_AVPHYS_PAGES")
+
+
+def get_pools(partitions_dir):
+    if partitions_dir not in worker_pools:
+        worker_pools.clear()
+        X, y, meta = load_matrices(partitions_dir)
+        split = meta["split"]
+        train_pool = Pool(X[:split], y[:split], feature_names=meta["feature_names"])
+        train_pool.quantize()
+        eval_pool = Pool(X[split:], y[split:], feature_names=meta["feature_names"])
+        worker_pools[partitions_dir] = (train_pool, eval_pool)
+    return worker_pools[partitions_dir]
+
+
+def run_trial(partitions_dir, params, iterations, thread_count, early_stopping_rounds):
+    start = time.perf_counter()
+    train_pool, eval_pool = get_pools(partitions_dir)
+    model = CatBoostRegressor(**dict(catboost_params, **params, iterations=iterations,
+                                     thread_count=thread_count, verbose=0, allow_writing_files=False))
+    model.fit(train_pool, eval_set=eval_pool, early_stopping_rounds=early_stopping_rounds, use_best_model=True)
+    score = model.get_best_score()["validation"][catboost_params["loss_function"]]
+    return score, model.get_best_iteration(), time.perf_counter() - start
+
+
+def sample_configs(station_id, pollutant_name, count, seed):
+    # The same seed gives the same configurations, so a resumed search matches the stored trials
+    rng = random.Random(f"{seed}_{station_id}_{pollutant_name}")
+    return [{name: sample(rng) for name, sample in search_space.items()} for _ in range(count)]
+
+
+def successive_halving(station_id, pollutant_name, partitions_dir, executor, store, configs, min_iterations,
+                       max_iterations, eta, thread_count, early_stopping_rounds):
+    candidates = list(range(len(configs)))
+    iterations = min_iterations
+    while True:
+        scores = {}
+        futures = {}
+        for config_id in candidates:
+            stored = store.get(station_id, pollutant_name, config_id, iterations)
+            if stored is not None:
+                scores[config_id] = stored[0]
+                continue
+            future = executor.submit(run_trial, partitions_dir, configs[config_id], iterations,
+                                     thread_count, early_stopping_rounds)
+            futures[future] = config_id
+        for future in as_completed(futures):
+            config_id = futures[future]
+            try:
+                score, best_iteration, duration = future.result()
+            except BaseException as e:
+                print(f"Trial {config_id} failed: {e!r}")
+                score, best_iteration, duration = None, None, None
+            store.add(station_id, pollutant_name, config_id, iterations, configs[config_id],
+                      score, best_iteration, duration)
+            scores[config_id] = score
+
+        ranked = sorted((config_id for config_id in candidates if scores[config_id] is not None),
+                        key=lambda config_id: scores[config_id])
+        if ranked:
+            print(f"Station {station_id}, {pollutant_name}: {len(candidates)} configurations at "
+                  f"{iterations} iterations, best score {scores[ranked[0]]:.5f}")
+        if iterations >= max_iterations or len(ranked) <= 1:
+            return
+        candidates = ranked[:max(len(ranked) // eta, 1)]
+        iterations = min(iterations * eta, max_iterations)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--stations", type=int, nargs="+", default=StationRegistry().ids())
+    parser.add_argument("--pollutants", nargs="+", default=POLLUTANTS)
+    parser.add_argument("--features", default=FEATURES_PATH, help="Feature partitions built by train.py")
+    parser.add_argument("--trials", default=TRIALS_PATH)
+    parser.add_argument("--configs", type=int, default=27, help="Configurations sampled per model")
+    parser.add_argument("--min-iterations", type=int, default=50)
+    parser.add_argument("--max-iterations", type=int, default=1000)
+    parser.add_argument("--eta", type=int, default=3, help="1/eta of the configurations survive each round")
+    parser.add_argument("--early-stopping-rounds", type=int, default=30)
+    parser.add_argument("--jobs", type=int, default=os.cpu_count(), help="Parallel trials")
+    parser.add_argument("--memory", type=float, default=None,
+                        help="GB the workers may use, defaults to the memory available at start")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--save", action="store_true", help="Refit the best configurations into pretrained_models/")
+    args = parser.parse_args()
+
+    store = TrialStore(args.trials)
+    memory = args.memory * 2 ** 30 if args.memory is not None else available_memory()
+
+    for station_id in args.stations:
+        for pollutant_name in args.pollutants:
+            partitions_dir = materialize(station_id, pollutant_name, args.features)
+            if partitions_dir is None:
+                print(f"No features for {pollutant_name} on station {station_id}, skipping.")
+                continue
+            jobs = max(min(args.jobs, int(memory // worker_memory(partitions_dir))), 1)
+            if jobs < args.jobs:
+                print(f"Station {station_id}, {pollutant_name}: running {jobs} workers, "
+                      f"{args.jobs} would need {args.jobs * worker_memory(partitions_dir) / 2 ** 30:.1f} GB")
+            thread_count = max(os.cpu_count() // jobs, 1)
+            configs = sample_configs(station_id, pollutant_name, args.configs, args.seed)
+            with ProcessPoolExecutor(max_workers=jobs) as executor:
+                successive_halving(station_id, pollutant_name, partitions_dir, executor, store, configs,
+                                   args.min_iterations, args.max_iterations, args.eta, thread_count,
+                                   args.early_stopping_rounds)
+
+            best = store.best(station_id, pollutant_name)
+            if best is None:
+                continue
+            params, score, best_iteration = best
+            print(f"Station {station_id}, {pollutant_name}: best score {score:.5f} with {params}, "
+                  f"{best_iteration + 1} iterations")
+            if args.save:
+                # Refit on the whole period, held-out part included, with the
+                # number of trees the early stopping found, once the workers exited
+                X, y, meta = load_matrices(partitions_dir)
+                pool = Pool(X, y, feature_names=meta["feature_names"])
+                pool.quantize()
+                model = CatBoostRegressor(**dict(catboost_params, **params, iterations=best_iteration + 1,
+                                                 thread_count=jobs * thread_count,
+                                                 allow_writing_files=False))
+                model.fit(pool)
+                os.makedirs("pretrained_models", exist_ok=True)
+                model.save_model(f"pretrained_models/{station_id}_{pollutant_name}.cbm")
+
+
+if __name__ == "__main__":
+    main()
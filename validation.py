@@ -0,0 +1,184 @@
+from lazy import LazyModule
+
+np = LazyModule("numpy")
+pd = LazyModule("pandas")
+
+# Data-quality checks on hourly frames (a "datetime" column and one column per
+# parameter). Every check works on whole columns and returns a boolean mask of
+# the same shape as the values, True where a value is rejected.
+
+# Plausible values per parameter: mg/m3 for pollutants, °C, m/s, degrees, mm Hg, %, mm
+RANGES = {
+    "co": (0, 50),
+    "no2": (0, 5),
+    "no": (0, 5),
+    "pm10": (0, 5),
+    "pm25": (0, 5),
+    "temperature": (-50, 50),
+    "outside_temperature": (-50, 50),
+    "wind_speed": (0, 50),
+    "253_wind_speed": (0, 60),
+    "wind_direction": (0, 360),
+    "253_wind_direction": (0, 360),
+    "pressure": (680, 800),
+    "humidity": (0, 105),
+    "precipitation": (0, 100)
+}
+
+# Profiler temperatures t_<height>m
+PROFILE_RANGE = (-50, 50)
+
+# A sensor repeating the same value for this many hours is considered stuck.
+# Parameters that are legitimately constant for long (precipitation, calm wind,
+# humidity at 100 % in fog or rain) are not checked. Pressure is reported in
+# whole mm Hg, so it can stay the same for half a day in calm weather.
+STUCK_HOURS = dict({name: 12 for name in ["co", "no2", "no", "pm10", "pm25", "temperature"]}, pressure=48)
+
+# Low concentrations are reported at the resolution of the analyzers (e.g. CO in
+# steps of 0.1 mg/m3), so runs at or below these values are not considered stuck
+RESOLUTION_FLOOR = {"co": 0.1, "no2": 0.001, "no": 0.001, "pm10": 0.001, "pm25": 0.001}
+
+# Not compared across stations: circular directions, and precipitation, which is
+# often local to a few stations
+NOT_COMPARABLE = ["wind_direction", "253_wind_direction", "precipitation"]
+
+
+def value_columns(frame):
+    return [name for name in frame.columns if name != "datetime"]
+
+
+def value_range(column):
+    if column in RANGES:
+        return RANGES[column]
+    if column.startswith("t_") and column.endswith("m"):
+        return PROFILE_RANGE
+    return None
+
+
+def range_mask(frame):
+    columns = value_columns(frame)
+    values = frame[columns].to_numpy(dtype=np.float64)
+    low = np.array([(value_range(name) or (-np.inf, np.inf))[0] for name in columns])
+    high = np.array([(value_range(name) or (-np.inf, np.inf))[1] for name in columns])
+    with np.errstate(invalid="ignore"):
+        mask = (values < low) | (values > high)
+    return pd.DataFrame(mask, index=frame.index, columns=columns)
+
+
+def run_lengths(is_same):
+    # Length of the run every element belongs to, runs are consecutive True in
+    # is_same[i] ("element i equals element i - 1"), per column
+    rows, columns = is_same.shape
+    run_starts = np.ones((rows, columns), dtype=bool)
+    run_starts[1:] = ~is_same[1:]
+    run_ids = np.cumsum(run_starts.ravel(order="F")).reshape((rows, columns), order="F")
+    lengths = np.bincount(run_ids.ravel())
+    return lengths[run_ids]
+
+
+def stuck_mask(frame, stuck_hours=STUCK_HOURS):
+    # Values in runs of identical readings of at least stuck_hours[column] hours.
+    # Rows are expected to be consecutive hours.
+    columns = value_columns(frame)
+    mask = np.zeros((frame.shape[0], len(columns)), dtype=bool)
+    checked = [i for i, name in enumerate(columns) if name in stuck_hours]
+    if checked and frame.shape[0] > 1:
+        values = frame[[columns[i] for i in checked]].to_numpy(dtype=np.float64)
+        is_same = np.zeros(values.shape, dtype=bool)
+        is_same[1:] = (values[1:] == values[:-1])
+        limits = np.array([stuck_hours[columns[i]] for i in checked])
+        floors = np.array([RESOLUTION_FLOOR.get(columns[i], -np.inf) for i in checked])
+        with np.errstate(invalid="ignore"):
+            mask[:, checked] = (run_lengths(is_same) >= limits) & (values > floors)
+    return pd.DataFrame(mask, index=frame.index, columns=columns)
+
+
+def cross_station_mask(frames, threshold=3, min_stations=5):
+    # {station: mask} of values more than threshold standard deviations from the
+    # mean of the other stations at the same hour. Only hours with readings from
+    # at least min_stations stations are checked. (Including the value itself in
+    # the mean and deviation bounds its z-score by (n - 1) / sqrt(n), below 3 for
+    # ten stations.)
+    stations = list(frames)
+    columns = sorted({name for frame in frames.values() for name in value_columns(frame)
+                      if name not in NOT_COMPARABLE})
+    datetimes = pd.DatetimeIndex(sorted(set().union(*[frame["datetime"] for frame in frames.values()])))
+    values = np.stack([frames[station].set_index("datetime").reindex(index=datetimes, columns=columns)
+                       .to_numpy(dtype=np.float64) for station in stations])
+
+    # Leave-one-out mean and deviation from per-hour sums over the stations
+    is_known = ~np.isnan(values)
+    known_values = np.where(is_known, values, 0)
+    counts = is_known.sum(axis=0)
+    sums = known_values.sum(axis=0)
+    squares = (known_values ** 2).sum(axis=0)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        others = counts - 1
+        mean = (sums - known_values) / others
+        variance = (squares - known_values ** 2 - others * mean ** 2) / (others - 1)
+        std = np.sqrt(np.maximum(variance, 0))
+        outliers = is_known & (counts >= min_stations) & (np.abs(values - mean) > threshold * std)
+
+    masks = {}
+    for i, station in enumerate(stations):
+        frame = frames[station]
+        station_mask = pd.DataFrame(outliers[i], index=datetimes, columns=columns)
+        station_mask = station_mask.reindex(index=pd.DatetimeIndex(frame["datetime"]),
+                                            columns=value_columns(frame), fill_value=False)
+        masks[station] = pd.DataFrame(station_mask.to_numpy(), index=frame.index, columns=value_columns(frame))
+    return masks
+
+
+def gap_report(frame):
+    # {column: (missing hours, longest gap in hours)} over the span of the frame
+    if frame.empty:
+        return {}
+    hourly = frame.set_index("datetime").sort_index()
+    hourly = hourly[~hourly.index.duplicated()].asfreq("1h")
+    values = hourly.to_numpy(dtype=np.float64)
+    is_missing = np.isnan(values)
+    is_same = np.zeros(values.shape, dtype=bool)
+    is_same[1:] = is_missing[1:] == is_missing[:-1]
+    longest = np.where(is_missing, run_lengths(is_same), 0).max(axis=0)
+    return {name: (int(is_missing[:, i].sum()), int(longest[i])) for i, name in enumerate(hourly.columns)}
+
+
+def validate(frame):
+    # Range and stuck-sensor masks of one station's frame
+    return {"range": range_mask(frame), "stuck": stuck_mask(frame)}
+
+
+def combine(masks):
+    result = None
+    for mask in masks.values():
+        result = mask if result is None else result | mask
+    return result
+
+
+def apply_masks(frame, masks):
+    # A copy of the frame with the rejected values replaced by NaN
+    result = frame.copy()
+    if masks:
+        mask = combine(masks)
+        result[mask.columns] = result[mask.columns].mask(mask)
+    return result
+
+
+def quality_report(frame, masks):
+    # {column: {"rows", "missing", "longest_gap", <check>: rejected values}}
+    gaps = gap_report(frame)
+    report = {}
+    for name in value_columns(frame):
+        missing, longest_gap = gaps.get(name, (0, 0))
+        report[name] = {"rows": int(frame.shape[0]),
+                        "missing": missing,
+                        "longest_gap": longest_gap}
+        for check, mask in masks.items():
+            report[name][check] = int(mask[name].sum()) if name in mask.columns else 0
+    return report
+
+
+def clean(frame):
+    # Validated frame and quality report of one station
+    masks = validate(frame)
+    return apply_masks(frame, masks), quality_report(frame, masks)